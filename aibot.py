@@ -1,28 +1,51 @@
 #!/usr/bin/env python3
 
+import time
+# Startup milestones are seconds from here, before the heavy imports
+started = time.monotonic()
+
 import os
-import yaml
-from wallstreet import Stock
 import random
-import shelve
 import json
 from pprint import pformat
-import requests
 import datetime
 import pytimeparse
 from telegram import InputFile
 from io import BytesIO
-from telegram.ext import Updater, CommandHandler, Filters, MessageHandler, RegexHandler, CallbackQueryHandler
+from telegram.ext import Updater, CommandHandler, Filters, MessageHandler, CallbackQueryHandler, TypeHandler
 import telegram
 import logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+import threading
+from functools import wraps
+from storage import Store, Quote
+from matcher import TextMatcher
+from tenor import Tenor, GifPool, search_keyword, TENOR_URL
+from httpclient import HTTPClient
+from watches import WatchScheduler
+from sendqueue import SendQueue, QueuedBot, PRIORITY_HIGH, PRIORITY_LOW
+from telegram.utils.request import Request
+from aio import AsyncWebhook
+from timers import TimerStore
+from cache import TTLCache
+from chatcache import MemberCache, ChatMetaCache, MemberUpdate
+import telegram.utils.webhookhandler
+from stocks import StockQuotes
+from executor import ChatExecutor
+from metrics import Metrics, MetricsServer
+from replies import Replies
+from texts import get_quote_link, fmt_quote, fmt_quotes, generate_damage_text
+import shard
+import logsetup
+import configfile
+
+startup = {}
 
 
 def logged(func):
+    @wraps(func)
     def logged_func(*argl, **argd):
-        logging.getLogger().debug("Entering: " + func.__name__)
+        logsetup.set_context(handler=func.__name__)
+        logging.getLogger().debug("Entering: %s", func.__name__)
         try:
             res = func(*argl, **argd)
         except Exception as e:
@@ -32,7 +55,7 @@ def logged(func):
                 update = argl[1]
             update.message.reply_text("{}: {}".format(str(type(e)), str(e)))
             raise e
-        logging.getLogger().debug("Exiting: " + func.__name__)
+        logging.getLogger().debug("Exiting: %s", func.__name__)
         return res
 
     return logged_func
@@ -40,41 +63,105 @@ def logged(func):
 
 config_path = "config.yaml"
 action_path = "actions.yaml"
-config = {}
-with open(config_path, "r") as f:
-    config = yaml.load(f)
-with open(action_path, "r") as f:
-    actions = yaml.load(f)["actions"]
+config = configfile.load(config_path)
+actions = configfile.load(action_path)["actions"]
+
+
+def config_file_mtimes():
+    return dict((path, os.stat(path).st_mtime) for path in (config_path, action_path))
+
+
+config_mtimes = config_file_mtimes()
+log_handler, log_listener = logsetup.setup(config.get("logging", {}))
 tg_key = config["apikey"]
+shard_index, shard_count = shard.current()
 tenorkey = config["tenorkey"]
-res = requests.get("https://api.tenor.com/v1/anonid", params={"key": tenorkey})
-anonid = res.json()["anon_id"]
-updater = Updater(tg_key, workers=16)
+upstream_config = config.get("upstreams", {})
+metrics = Metrics()
+http = HTTPClient(metrics=metrics)
+http.add("tenor", **upstream_config.get("tenor", {}))
+http.add("yahoo", **upstream_config.get("yahoo", {}))
+stock_quotes = StockQuotes(http, **config.get("stock_cache", {}))
+db = Store("data.sqlite3")
+if db.migrate_shelve("data.db"):
+    logging.getLogger().info("Migrated shelve data.db into data.sqlite3")
+tenor = Tenor(tenorkey, http, config.get("tenor_url", TENOR_URL), meta=db.meta)
+gif_pool = GifPool(tenor.random)
+send_queue_config = dict(config.get("send_queue", {}))
+# The Bot API's global limit is split between worker processes
+send_queue_config["global_rate"] = send_queue_config.get("global_rate", 30) / float(shard_count)
+send_queue = SendQueue(metrics=metrics, **send_queue_config)
+updater = Updater(bot=QueuedBot(tg_key, base_url=config.get("bot_api_url"), send_queue=send_queue,
+                                request=Request(con_pool_size=24)), workers=16)
+# PTB's own webhook server parses with this class too, so member status
+# changes reach the caches in every run mode
+telegram.utils.webhookhandler.Update = MemberUpdate
+ALLOWED_UPDATES = ["message", "edited_message", "channel_post", "edited_channel_post",
+                   "callback_query", "chat_member", "my_chat_member"]
+webhook_config = config.get("webhook", {})
+webhook_listen = webhook_config.get("listen", '127.0.0.1')
+webhook_port = webhook_config.get("port", 9990)
+webhook_url = webhook_config.get("url", 'https://tgbot.chaserhkj.me')
+# Updates and timers of one chat run in order, chats run in parallel
+chat_executor = ChatExecutor(**config.get("chat_executor", {}))
+process_update = updater.dispatcher.process_update
+# Set by setup() once the handlers are registered, updates that arrive
+# earlier wait for it in their chat's queue
+ready = threading.Event()
+
+
+def mark_startup(name):
+    startup[name] = round(time.monotonic() - started, 3)
+    logging.getLogger().info("Startup: %s after %.3fs", name, startup[name])
+
+
+def timed_update(update, arrived, chat_id):
+    # Time from arrival to the last handler, including the wait for the chat
+    logsetup.set_context(update_id=update.update_id, chat_id=chat_id)
+    try:
+        ready.wait()
+        process_update(update)
+    finally:
+        metrics.observe("aibot_update_seconds", time.monotonic() - arrived)
+        logsetup.clear_context()
+        if "first_update" not in startup:
+            mark_startup("first_update")
+
+
+def dispatch_by_chat(update):
+    if not isinstance(update, telegram.Update):
+        return process_update(update)
+    metrics.inc("aibot_updates_total")
+    chat_id = shard.effective_chat_id(update)
+    return chat_executor.submit(chat_id, timed_update, update, time.monotonic(), chat_id)
+
+
+updater.dispatcher.process_update = dispatch_by_chat
 queue = updater.job_queue
-db = shelve.open("data.db")
-if not "sticker_response" in db:
-    db["sticker_response"] = {}
-if not "text_response" in db:
-    db["text_response"] = {}
-if not "user_ids" in db:
-    db["user_ids"] = {}
-if not "quotes" in db:
-    db["quotes"] = {}
+timers = TimerStore(db, shard=shard_index, shards=shard_count,
+                    submit=chat_executor.submit)
+
+
+def run_in_chat(chat_id, callback, when):
+    # The job queue thread only hands the callback to the chat's executor
+    # queue, so it runs in order with that chat's updates
+    queue.run_once(lambda bot, job: chat_executor.submit(
+        chat_id, callback, bot, job), when)
+
 
 group_config = config["groups"]
-reset_events = {}
-unpin_events = {}
-result_cache = {}
-gif_cache = {}
-regex_handlers = {}
+sent_gifs = TTLCache(maxsize=20000, ttl=1800)
+text_matcher = TextMatcher()
 owner = config["owner"]
-response_cd = set()
 quote_moderator = [owner]
+member_cache = MemberCache()
+chat_meta = ChatMetaCache()
 if "quote_moderator" in config:
     quote_moderator.extend(config["quote_moderator"])
 
 
 def check_owner(func):
+    @wraps(func)
     def new_func(*arg, **argd):
         update = argd.get("update", arg[1])
         if update.message.from_user.id != owner:
@@ -87,11 +174,12 @@ def check_owner(func):
 
 
 def check_restrict(func):
+    @wraps(func)
     def new_func(*arg, **argd):
         update = argd.get("update", arg[1])
         bot = argd.get("bot", arg[0])
         uid = update.message.from_user.id
-        member = bot.get_chat_member(update.message.chat.id, uid)
+        member = member_cache.get(bot, update.message.chat.id, uid)
         if not (member.status == 'creator' or member.can_restrict_members):
             update.message.reply_text("你没有管理小黑屋的权限哦")
             update.message.chat.send_sticker(
@@ -103,11 +191,12 @@ def check_restrict(func):
 
 
 def check_admin(func):
+    @wraps(func)
     def new_func(*arg, **argd):
         update = argd.get("update", arg[1])
         bot = argd.get("bot", arg[0])
         uid = update.message.from_user.id
-        member = bot.get_chat_member(update.message.chat.id, uid)
+        member = member_cache.get(bot, update.message.chat.id, uid)
         if not (member.status == 'creator' or member.status == 'administrator'):
             update.message.reply_text("你没有管理员权限哦")
             update.message.chat.send_sticker(
@@ -119,6 +208,7 @@ def check_admin(func):
 
 
 def check_group(func):
+    @wraps(func)
     def new_func(*arg, **argd):
         update = argd.get("update", arg[1])
         chat = update.message.chat
@@ -130,6 +220,10 @@ def check_group(func):
     return new_func
 
 
+def owns(gid):
+    return shard.shard_of(gid, shard_count) == shard_index
+
+
 def check_config(gid, key):
     if gid in group_config and key in group_config[gid]:
         return group_config[gid][key]
@@ -165,16 +259,9 @@ def settitle(bot, update, args):
 
     delay = check_config(gid, "title_reset_delay")
     if delay != None:
-        if gid in reset_events:
-            reset_events[gid].schedule_removal()
         reset_title = old_title if prefix == None else prefix
-
-        def reset(bot, job):
-            bot.set_chat_title(chat_id=gid, title=reset_title)
-            del reset_events[gid]
-
-        event = queue.run_once(reset, delay)
-        reset_events[gid] = event
+        timers.schedule("reset_title", gid, delay,
+                        {"gid": gid, "title": reset_title}, chat_id=gid)
         update.message.reply_text("呼姆，这个群设置了默认群名呢……我会在{}秒后将群名重置为{}的……".format(
             delay, reset_title))
 
@@ -188,9 +275,14 @@ def resettitle(bot, update):
         update.message.reply_text("No title prefix setup!")
         return
     bot.set_chat_title(chat_id=gid, title=prefix)
-    if gid in reset_events:
-        reset_events[gid].schedule_removal()
-        del reset_events[gid]
+    timers.cancel("reset_title", gid)
+
+
+def timed_reset_title(bot, payload):
+    bot.set_chat_title(chat_id=payload["gid"], title=payload["title"])
+
+
+timers.register("reset_title", timed_reset_title)
 
 
 @check_group
@@ -233,62 +325,70 @@ def pin(bot, update, args):
     if len(args) == 0:
         return
     delay = pytimeparse.parse(args[0])
-    if gid in unpin_events:
-        unpin_events[gid].schedule_removal()
+    timers.schedule("unpin", gid, delay, {"gid": gid}, chat_id=gid)
+
 
-    def unpin(bot, job):
-        bot.unpin_chat_message(chat_id=gid)
-        del unpin_events[gid]
+def timed_unpin(bot, payload):
+    bot.unpin_chat_message(chat_id=payload["gid"])
 
-    event = queue.run_once(unpin, delay)
-    unpin_events[gid] = event
+
+timers.register("unpin", timed_unpin)
 
 
 def sendGIF(bot, cid, keyword, anime=True, reply_msg=None):
-    if anime:
-        keyword = "anime {}".format(keyword)
-    if not cid in gif_cache:
-        gif_cache[cid] = set()
-    if not cid in result_cache:
-        result_cache[cid] = {}
+    keyword = search_keyword(keyword, anime)
     while True:
-        if not keyword in result_cache[cid]:
-            res = requests.get(
-                "https://api.tenor.com/v1/random",
-                params={
-                    "key": tenorkey,
-                    "anon_id": anonid,
-                    "q": keyword,
-                    "safesearch": "moderate",
-                    "limit": 20
-                })
-            result_cache[cid][keyword] = iter(res.json()["results"])
-
-            def result_ttl(bot, job):
-                del result_cache[cid][keyword]
-
-            queue.run_once(result_ttl, 600)
-        for result in result_cache[cid][keyword]:
-            url = result["media"][0]["gif"]["url"]
-            if not url in gif_cache[cid]:
-                gif_cache[cid].add(url)
-
-                def remove_cache(bot, job):
-                    gif_cache[cid].remove(url)
-
-                queue.run_once(remove_cache, 1800)
-                bot.sendChatAction(
-                    chat_id=cid, action=telegram.ChatAction.UPLOAD_PHOTO)
-                if reply_msg == None:
-                    bot.sendDocument(chat_id=cid, document=url, timeout=60)
-                else:
-                    bot.sendDocument(
-                        chat_id=cid,
-                        document=url,
-                        timeout=60,
-                        reply_to_message_id=reply_msg.message_id)
-                return
-        del result_cache[cid][keyword]
+        result = gif_pool.take(keyword)
+        if result == None:
+            return
+        url = result["media"][0]["gif"]["url"]
+        # Same GIF is not repeated in a chat for half an hour
+        if not sent_gifs.add((cid, url)):
+            continue
+        reply_to = None if reply_msg == None else reply_msg.message_id
+        # Telegram keeps every GIF it fetched once, resend it by file_id.
+        # Sends are low priority and return Futures, what depends on their
+        # result runs on the send queue once they are done.
+        file_id = db.gif_file_ids.get(url)
+        if file_id != None:
+            sent = bot.sendDocument(
+                chat_id=cid, document=file_id, reply_to_message_id=reply_to)
+            sent.add_done_callback(
+                lambda future: resend_gif(bot, cid, url, reply_to, future))
+            return
+        upload_gif(bot, cid, url, reply_to)
+        return
+
+
+def upload_gif(bot, cid, url, reply_to):
+    bot.sendChatAction(
+        chat_id=cid, action=telegram.ChatAction.UPLOAD_PHOTO)
+    sent = bot.sendDocument(
+        chat_id=cid,
+        document=url,
+        timeout=60,
+        reply_to_message_id=reply_to)
+    sent.add_done_callback(lambda future: remember_gif(url, future))
+
+
+def remember_gif(url, future):
+    if future.exception() != None:
+        logging.getLogger().warning("Sending GIF %s failed: %s", url, future.exception())
+        return
+    if future.result().document != None:
+        db.gif_file_ids[url] = future.result().document.file_id
+
+
+def resend_gif(bot, cid, url, reply_to, future):
+    # Telegram forgot the file_id, upload the GIF from its URL again
+    if isinstance(future.exception(), telegram.error.BadRequest):
+        try:
+            del db.gif_file_ids[url]
+        except KeyError:
+            pass
+        upload_gif(bot, cid, url, reply_to)
+    elif future.exception() != None:
+        logging.getLogger().warning("Sending GIF %s failed: %s", url, future.exception())
 
 
 def action_gen(keyword, reply_text, mention_text, self_text, anime=True):
@@ -297,21 +397,21 @@ def action_gen(keyword, reply_text, mention_text, self_text, anime=True):
         cid = update.message.chat.id
         if msg == None:
             sendGIF(bot, cid, keyword, anime, update.message)
-            update.message.reply_text(reply_text)
+            update.message.reply_text(reply_text, priority=PRIORITY_LOW)
             return
         target_id = msg.from_user.id
-        self_id = bot.get_me().id
+        self_id = chat_meta.get_me(bot).id
         user = update.message.from_user
         sendGIF(bot, cid, keyword, anime, msg)
         if target_id == self_id:
-            update.message.reply_text(self_text)
+            update.message.reply_text(self_text, priority=PRIORITY_LOW)
             return
         msg.reply_text(
             "[{} {}](tg://user?id={}) {}".format(
                 "" if user.first_name == None else user.first_name, ""
                 if user.last_name == None else user.last_name, user.id,
                 mention_text),
-            parse_mode="Markdown")
+            parse_mode="Markdown", priority=PRIORITY_LOW)
 
     return logged(action)
 
@@ -321,12 +421,31 @@ def action_gen(keyword, reply_text, mention_text, self_text, anime=True):
 def unpin(bot, update):
     gid = update.message.chat.id
     bot.unpin_chat_message(chat_id=gid)
-    if gid in unpin_events:
-        unpin_events[gid].schedule_removal()
-        del unpin_events[gid]
+    timers.cancel("unpin", gid)
+
+
+def schedule_unban(gid, uid, delay, release_text):
+    timers.schedule("unban", "{}_{}".format(gid, uid), delay,
+                    {"gid": gid, "uid": uid, "text": release_text}, chat_id=gid)
+
+
+def timed_unban(bot, payload):
+    gid = payload["gid"]
+    bot.restrict_chat_member(
+        gid,
+        payload["uid"],
+        can_send_messages=True,
+        can_send_media_messages=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True,
+        timeout=10)
+    member_cache.invalidate(gid, payload["uid"])
+    bot.send_message(gid, payload["text"], parse_mode="Markdown",
+                     priority=PRIORITY_HIGH)
+    bot.send_sticker(gid, sticker="CAADBQADbAEAAgsiPA5ZwMJd8rkuxgI")
 
 
-unban_events = {}
+timers.register("unban", timed_unban)
 
 
 @check_group
@@ -347,7 +466,7 @@ def ban(bot, update, args):
 
 
 def ban_user(bot, chat, user, ban_time=None):
-    member = chat.get_member(user.id)
+    member = member_cache.get(bot, chat.id, user.id)
     if member.status == 'creator' or member.status == 'administrator':
         chat.send_message("呃呃，我没有处理管理员的权限啊！")
         chat.send_sticker(
@@ -363,35 +482,15 @@ def ban_user(bot, chat, user, ban_time=None):
         can_send_other_messages=False,
         can_add_web_page_previews=False,
         timeout=10)
+    member_cache.invalidate(gid, uid)
     chat.send_message("{} 跟我乖乖到小黑屋里走一趟吧, 刑期: {}".format(user.mention_markdown(), "无限" if ban_time == None else ban_time),
-                      parse_mode="Markdown")
+                      parse_mode="Markdown", priority=PRIORITY_HIGH)
     chat.send_sticker(sticker="CAADBQADJwIAAgsiPA7OflnL6kErDgI")
     if ban_time == None:
         return
     delay = pytimeparse.parse(ban_time)
-    if not gid in unban_events:
-        unban_events[gid] = {}
-    if uid in unban_events[gid]:
-        unban_events[gid][uid].schedule_removal()
-
-    def timed_unban(bot, job):
-        bot.restrict_chat_member(
-            gid,
-            uid,
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-            timeout=10)
-        chat.send_message(
-            text="{}刑满释放了！".format(user.mention_markdown()),
-            parse_mode="Markdown")
-        chat.send_sticker(
-            sticker="CAADBQADbAEAAgsiPA5ZwMJd8rkuxgI")
-        del unban_events[gid][uid]
-
-    event = queue.run_once(timed_unban, delay)
-    unban_events[gid][uid] = event
+    schedule_unban(gid, uid, delay,
+                   "{}刑满释放了！".format(user.mention_markdown()))
 
 
 @check_group
@@ -404,7 +503,7 @@ def banpic(bot, update, args):
             "Usage:\n\nReplying to the user you wish to ban.\n/banpic [Ban Time]\n"
         )
         return
-    member = update.message.chat.get_member(msg.from_user.id)
+    member = member_cache.get(bot, update.message.chat.id, msg.from_user.id)
     if member.status == 'creator' or member.status == 'administrator':
         update.message.reply_text("呃呃，我没有处理管理员的权限啊！")
         update.message.chat.send_sticker(
@@ -421,41 +520,20 @@ def banpic(bot, update, args):
         can_send_other_messages=False,
         can_add_web_page_previews=False,
         timeout=10)
+    member_cache.invalidate(gid, uid)
     update.message.reply_text(
         "[{} {}](tg://user?id={}) {}".format(
             "" if user.first_name == None else user.first_name, ""
             if user.last_name == None else user.last_name, user.id,
             "把头伸过来，我给你加个不能发图的buff"),
-        parse_mode="Markdown")
+        parse_mode="Markdown", priority=PRIORITY_HIGH)
     update.message.chat.send_sticker(sticker="CAADBQADJwIAAgsiPA7OflnL6kErDgI")
     if len(args) == 0:
         return
     delay = pytimeparse.parse(args[0])
-    if not gid in unban_events:
-        unban_events[gid] = {}
-    if uid in unban_events[gid]:
-        unban_events[gid][uid].schedule_removal()
-
-    def timed_unban(bot, job):
-        bot.restrict_chat_member(
-            gid,
-            uid,
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-            timeout=10)
-        update.message.chat.send_text(
-            "[{} {}](tg://user?id={}) {}".format(
-                "" if user.first_name == None else user.first_name, "" if
-                user.last_name == None else user.last_name, user.id, "刑满释放了！"),
-            parse_mode="Markdown")
-        update.message.chat.send_sticker(
-            sticker="CAADBQADbAEAAgsiPA5ZwMJd8rkuxgI")
-        del unban_events[gid][uid]
-
-    event = queue.run_once(timed_unban, delay)
-    unban_events[gid][uid] = event
+    schedule_unban(gid, uid, delay, "[{} {}](tg://user?id={}) {}".format(
+        "" if user.first_name == None else user.first_name, "" if
+        user.last_name == None else user.last_name, user.id, "刑满释放了！"))
 
 
 @check_group
@@ -467,7 +545,7 @@ def unban(bot, update):
         update.message.reply_text(
             "Usage:\n\nReplying to the user you wish to unban.\n/unban\n")
         return
-    member = update.message.chat.get_member(msg.from_user.id)
+    member = member_cache.get(bot, update.message.chat.id, msg.from_user.id)
     if member.status != 'restricted':
         update.message.reply_text("呃呃，他就不在小黑屋里面啊")
         update.message.chat.send_sticker(
@@ -484,17 +562,14 @@ def unban(bot, update):
         can_send_other_messages=True,
         can_add_web_page_previews=True,
         timeout=10)
+    member_cache.invalidate(gid, uid)
     update.message.reply_text(
         "[{} {}](tg://user?id={}) {}".format(
             "" if user.first_name == None else user.first_name, "" if
             user.last_name == None else user.last_name, user.id, "从小黑屋里放出来了！"),
-        parse_mode="Markdown")
+        parse_mode="Markdown", priority=PRIORITY_HIGH)
     update.message.chat.send_sticker(sticker="CAADBQADbAEAAgsiPA5ZwMJd8rkuxgI")
-    if not gid in unban_events:
-        unban_events[gid] = {}
-    if uid in unban_events[gid]:
-        unban_events[gid][uid].schedule_removal()
-        del unban_events[gid][uid]
+    timers.cancel("unban", "{}_{}".format(gid, uid))
 
 
 @logged
@@ -514,7 +589,8 @@ def list_cmd(bot, update):
 /quote     : Print a random quote
 /addquote  : Add a message to the quotes
 /rmquote   : Remove a message from the quotes
-/lsquotes  : Show quotes list
+/lsquotes  : Show quotes list, optionally from a page
+/searchquote: Search quotes by text or author
 /actions   : Show action commands
 /setsres   : Set up sticker response
 /delsres   : Delete sticker response
@@ -527,6 +603,8 @@ def list_cmd(bot, update):
 /banpic    : Ban user to send pictures for a certain period of time
 /unban     : Unban user from previous bans
 /duel      : Invite other player to a duel
+/stats     : Show bot statistics
+/reload    : Reload config.yaml and actions.yaml
 /help      : Show non-action commands"""
     update.message.reply_text(help_txt)
 
@@ -556,39 +634,12 @@ def getuid(bot, update):
     update.message.reply_text("Your User ID:{}".format(user.id))
 
 
-def respond(bot, update, response):
-    chance = response[0]
-    cd = response[1]
-    rtype = response[2].lower()
-    content = response[3]
-    sig = (rtype, content)
-    if sig in response_cd:
-        return
-    if cd > 0:
-        response_cd.add(sig)
-
-        def reset_cd(bot, job):
-            response_cd.remove(sig)
-
-        queue.run_once(reset_cd, cd)
-    if 0 < chance and chance < 1:
-        if random.uniform(0, 1) > chance:
-            return
-    if rtype == "text":
-        update.message.reply_text(content, parse_mode="Markdown")
-    elif rtype == "sticker":
-        update.message.reply_sticker(content)
-    elif rtype == "gif":
-        sendGIF(bot, update.message.chat.id, content, False, update.message)
+replies = Replies(db, text_matcher, check_config, sendGIF, timers)
 
 
 @logged
 def sticker_response(bot, update):
-    log_user_id(bot, update)
-    sid = update.message.sticker.file_id
-    if not sid in db["sticker_response"]:
-        return
-    respond(bot, update, db["sticker_response"][sid])
+    replies.sticker_response(bot, update)
 
 
 @check_owner
@@ -604,10 +655,7 @@ def setsres(bot, update, args):
     cd = int(args[2])
     rtype = args[3]
     content = " ".join(args[4:])
-    sr = db["sticker_response"]
-    sr[sid] = (chance, cd, rtype, content)
-    db["sticker_response"] = sr
-    db.sync()
+    db.sticker_response[sid] = (chance, cd, rtype, content)
     update.message.reply_text("Entry updated")
 
 
@@ -618,24 +666,34 @@ def delsres(bot, update, args):
         update.message.reply_text("Usage: /delsres <sticker_id>")
         return
     sid = args[0]
-    if sid in db["sticker_response"]:
-        sr = db["sticker_response"]
-        del sr[sid]
-        db["sticker_response"] = sr
-        db.sync()
+    if sid in db.sticker_response:
+        del db.sticker_response[sid]
     update.message.reply_text("Entry deleted")
 
 
 @logged
 def lssres(bot, update):
-    update.message.reply_text(pformat(db["sticker_response"]))
+    update.message.reply_text(pformat(dict(db.sticker_response.items())))
 
 
-def generate_reghandler(response):
-    def handler(bot, update):
-        respond(bot, update, response)
+@logged
+def text_response(bot, update):
+    replies.text_response(bot, update)
 
-    return handler
+
+def touch_text_responses():
+    global text_response_version
+    text_response_version = str(time.time())
+    db.meta["text_response_version"] = text_response_version
+
+
+def reload_text_responses(bot, job):
+    # Other worker processes pick up /settres and /deltres through the store
+    global text_response_version
+    version = db.meta.get("text_response_version")
+    if version != text_response_version:
+        text_response_version = version
+        text_matcher.load(db.text_response.items())
 
 
 @check_owner
@@ -651,15 +709,10 @@ def settres(bot, update, args):
     cd = int(args[2])
     rtype = args[3]
     content = " ".join(args[4:])
-    tr = db["text_response"]
-    tr[regex] = (chance, cd, rtype, content)
-    db["text_response"] = tr
-    db.sync()
-    h = RegexHandler(regex, generate_reghandler(tr[regex]))
-    if regex in regex_handlers:
-        updater.dispatcher.remove_handler(regex_handlers[regex])
-    regex_handlers[regex] = h
-    updater.dispatcher.add_handler(h)
+    response = (chance, cd, rtype, content)
+    text_matcher.set(regex, response)
+    db.text_response[regex] = response
+    touch_text_responses()
     update.message.reply_text("Entry updated")
 
 
@@ -670,20 +723,16 @@ def deltres(bot, update, args):
         update.message.reply_text("Usage: /deltres <regex>")
         return
     regex = args[0]
-    if regex in db["text_response"]:
-        tr = db["text_response"]
-        del tr[regex]
-        db["text_response"] = tr
-        db.sync()
-    if regex in regex_handlers:
-        updater.dispatcher.remove_handler(regex_handlers[regex])
-        del regex_handlers[regex]
+    if regex in db.text_response:
+        del db.text_response[regex]
+    text_matcher.remove(regex)
+    touch_text_responses()
     update.message.reply_text("Entry deleted")
 
 
 @logged
 def lstres(bot, update):
-    update.message.reply_text(pformat(db["text_response"]))
+    update.message.reply_text(pformat(dict(db.text_response.items())))
 
 
 @logged
@@ -697,14 +746,22 @@ def shows(bot, update, args):
 @logged
 def stock(bot, update, args):
     if len(args) < 1:
-        update.message.reply_text("Usage: /stock <ticker>")
+        update.message.reply_text("Usage: /stock <ticker> [ticker ...]")
+        return
+    if len(args) == 1:
+        stk = stock_quotes.get(args[0])
+        update.message.reply_text("{}({}) 最近交易价格为{:.2f}, 最近交易日变动{:.2f}({:.1f}%)".format(
+            stk.name, stk.ticker, stk.price, stk.change, stk.cp))
         return
-    ticker = args[0]
-    stk = Stock(ticker, source="yahoo")
-    name = stk.name
-    name = name.replace("&amp;", "&")
-    update.message.reply_text("{}({}) 最近交易价格为{:.2f}, 最近交易日变动{:.2f}({:.1f}%)".format(
-        name, stk.ticker, stk.price, stk.change, stk.cp))
+    rows = []
+    for ticker, stk in stock_quotes.get_many(args):
+        if isinstance(stk, Exception):
+            rows.append("{:<6} {}".format(ticker, "查询失败"))
+        else:
+            rows.append("{:<6} {:>10.2f} {:>+9.2f} {:>+6.1f}%".format(
+                stk.ticker, stk.price, stk.change, stk.cp))
+    update.message.reply_text("```\n{:<6} {:>10} {:>9} {:>7}\n{}\n```".format(
+        "Ticker", "Price", "Change", "%", "\n".join(rows)), parse_mode="Markdown")
 
 
 count_watches = config["watches"]["count"]
@@ -719,25 +776,26 @@ def watch_count(gid, bot):
     if not gid in old_member_count:
         old_member_count[gid] = count
     if count < old_member_count[gid]:
-        chat = bot.get_chat(gid)
+        title = chat_meta.title(bot, gid)
         # Notify owner
         bot.send_message(owner, "{} member(s) have left group {}".format(
-            old_member_count[gid] - count, chat.title))
+            old_member_count[gid] - count, title), priority=PRIORITY_HIGH)
         # Notify group if set
-        if count_watches[gid]["notify"]:
+        if count_watches.get(gid, {}).get("notify"):
             bot.send_message(gid, "{} member(s) have left".format(
-                old_member_count[gid] - count))
+                old_member_count[gid] - count), priority=PRIORITY_HIGH)
         # Notify extra target if set
         notify_target = check_config(gid, "notify_watches_to")
         if notify_target:
             bot.send_message(notify_target, "{} member(s) have left group {}".format(
-                old_member_count[gid] - count, chat.title))
+                old_member_count[gid] - count, title), priority=PRIORITY_HIGH)
     old_member_count[gid] = count
 
 
 def callback_poll_count(bot, job):
     for gid in count_watches:
-        watch_count(gid, bot)
+        if owns(gid):
+            watch_count(gid, bot)
 
 
 member_watches = config["watches"]["member"]
@@ -746,57 +804,95 @@ old_status = {}
 
 def watch_member(gid, uid, bot):
     key = "{}_{}".format(gid, uid)
+    # The watch may have been dropped by a reload since it was scheduled
+    watch = member_watches.get(gid, {}).get(uid)
+    if watch == None:
+        return False
     try:
         member = bot.get_chat_member(gid, uid)
     except telegram.TelegramError:
-        return
+        return False
     if member == None:
-        return
+        return False
     user = member.user
     status = member.status
     if not key in old_status:
         old_status[key] = status
-    if status == 'left' and status != old_status[key]:
-        chat = bot.get_chat(gid)
+    changed = status != old_status[key]
+    if status == 'left' and changed:
+        title = chat_meta.title(bot, gid)
         # Notify Owner
         bot.send_message(owner, "{} have left group {}".format(
-            user.full_name, chat.title))
-        if member_watches[gid][uid]["message"]:
-            bot.send_message(owner, member_watches[gid][uid]["message"])
+            user.full_name, title), priority=PRIORITY_HIGH)
+        if watch["message"]:
+            bot.send_message(owner, watch["message"],
+                             priority=PRIORITY_HIGH)
         # Notify Group if set
-        if member_watches[gid][uid]["notify"]:
-            bot.send_message(gid, "{} have left".format(user.full_name))
-            if member_watches[gid][uid]["message"]:
-                bot.send_message(gid, member_watches[gid][uid]["message"])
+        if watch["notify"]:
+            bot.send_message(gid, "{} have left".format(user.full_name),
+                             priority=PRIORITY_HIGH)
+            if watch["message"]:
+                bot.send_message(gid, watch["message"],
+                                 priority=PRIORITY_HIGH)
         # Notify extra target if set
         notify_target = check_config(gid, "notify_watches_to")
         if notify_target:
             bot.send_message(notify_target, "{} have left group {}".format(
-                user.full_name, chat.title))
-            if member_watches[gid][uid]["message"]:
+                user.full_name, title), priority=PRIORITY_HIGH)
+            if watch["message"]:
                 bot.send_message(
-                    notify_target, member_watches[gid][uid]["message"])
+                    notify_target, watch["message"],
+                    priority=PRIORITY_HIGH)
         # Kick if set
-        if member_watches[gid][uid]["kick"]:
-            bot.kick_chat_member(gid, member_watches[gid][uid]["kick"])
+        if watch["kick"]:
+            bot.kick_chat_member(gid, watch["kick"])
     old_status[key] = status
+    return changed
 
 
-def callback_poll_member(bot, job):
-    for gid in member_watches:
-        for uid in member_watches[gid]:
-            watch_member(gid, uid, bot)
+def check_member(bot, key):
+    return watch_member(key[0], key[1], bot)
+
+
+member_scheduler = WatchScheduler(check_member, **config.get("watch_schedule", {}))
+for gid in member_watches:
+    if not owns(gid):
+        continue
+    for uid in member_watches[gid]:
+        member_scheduler.add((gid, uid))
+
+
+@check_owner
+@logged
+def stats(bot, update):
+    lines = [
+        "Shard {} of {}".format(shard_index + 1, shard_count),
+        "Member watches: {watches}\nChecks: {checks}, changes: {changes}\n"
+        "Delayed by API budget: {delayed}, missed a full interval: {skipped}".format(
+            **member_scheduler.stats()),
+        "Pending timers: {}".format(timers.pending()),
+        "Member cache: {cached} cached, {hits} hits, {misses} lookups".format(
+            **member_cache.stats()),
+        "Send queue: {queued} queued, {sent} sent, {merged} edits merged, {retried} retried".format(
+            **send_queue.stats()),
+        "Stock quotes: {cached} cached, {hits} hits, {misses} lookups, {shared} shared".format(
+            **stock_quotes.stats()),
+        "Chats in flight: {chats}, {queued} tasks queued, {done} done, {failed} failed".format(
+            **chat_executor.stats()),
+    ]
+    if async_webhook != None:
+        lines.append("Updates: {pending} in flight, {processed} processed".format(
+            **async_webhook.stats()))
+    update.message.reply_text("\n\n".join(lines))
+
+
+def observe_chats(bot, update):
+    member_cache.observe(update)
+    chat_meta.observe(update)
 
 
 def log_user_id(bot, update):
-    gid = update.message.chat.id
-    if check_config(gid, "log_uid"):
-        uid = update.message.from_user.id
-        uname = update.message.from_user.username
-        uid_dict = db["user_ids"]
-        uid_dict[uname] = uid
-        db["user_ids"] = uid_dict
-        db.sync()
+    replies.log_user_id(update)
 
 
 pending_posts = {}
@@ -823,12 +919,12 @@ def postit(bot, update):
     appr_btn_list = [[telegram.InlineKeyboardButton("Approve", callback_data="approve_post:{}".format(
         key))], [telegram.InlineKeyboardButton("Decline", callback_data="decline_post:{}".format(key))]]
     appr_markup = telegram.InlineKeyboardMarkup(appr_btn_list)
-    admins = bot.get_chat_administrators(chan_id)
+    admins = chat_meta.administrators(bot, chan_id)
     for member in admins:
         if not member.user.is_bot:
             try:
                 bot.send_message(member.user.id, content,
-                                 reply_markup=appr_markup)
+                                 reply_markup=appr_markup, priority=PRIORITY_HIGH)
             except telegram.error.Unauthorized:
                 continue
     msg.prompt = update.message.reply_text("Post pending approval.")
@@ -838,15 +934,6 @@ def postit(bot, update):
 pending_quote = {}
 
 
-def get_quote_link(q_id):
-    if not q_id.startswith("-100"):
-        return ""
-    q_id = q_id.split("_")
-    gid = q_id[0][4:]
-    mid = q_id[1]
-    return "t.me/c/{}/{}\n".format(gid, mid)
-
-
 @logged
 def addquote(bot, update):
     msg = update.message.reply_to_message
@@ -856,7 +943,7 @@ def addquote(bot, update):
         )
         return
     key = "{}_{}".format(msg.chat.id, msg.message_id)
-    if key in db["quotes"]:
+    if key in db.quotes:
         update.message.reply_text("Quote already added")
         return
     if key in pending_quote:
@@ -869,84 +956,137 @@ def addquote(bot, update):
         key))], [telegram.InlineKeyboardButton("Decline", callback_data="decline_quote:{}".format(key))]]
     appr_markup = telegram.InlineKeyboardMarkup(appr_btn_list)
     for uid in quote_moderator:
-        bot.send_message(uid, content, reply_markup=appr_markup)
+        bot.send_message(uid, content, reply_markup=appr_markup,
+                         priority=PRIORITY_HIGH)
     msg.prompt = update.message.reply_text("Quote pending approval.")
     pending_quote[key] = msg
 
 
-ls_quote_sessions = {}
+quote_page_size = config.get("quote_page_size", 3)
+
+
+def quote_page_markup(entries, page, total):
+    # The page position travels in the callback data, no session is kept
+    btn_list = [[telegram.InlineKeyboardButton("Previous Page", callback_data="lsquotes_previous:{}:{}".format(
+        entries[0][0], page))], [telegram.InlineKeyboardButton("Next Page", callback_data="lsquotes_next:{}:{}".format(
+            entries[-1][0], page))]]
+    pages = (total + quote_page_size - 1) // quote_page_size
+    jumps = sorted(set(p for p in (0, page - 5, page + 5, pages - 1)
+                       if 0 <= p < pages and p != page))
+    if len(jumps) != 0:
+        btn_list.append([telegram.InlineKeyboardButton("Page {}".format(
+            p + 1), callback_data="lsquotes_page:{}".format(p)) for p in jumps])
+    return telegram.InlineKeyboardMarkup(btn_list)
 
 
-def fmt_quotes(session):
-    i = session['i']
-    j = i + session['di']
-    header = "Quotes {}-{}, total {}\n\n".format(
-        i + 1, j, len(session["data"]))
-    quotes = [session['data'][key] for key in session['keys'][i:j]]
-    output = []
-    for quote in quotes:
-        output.append("ID:{}\n{}By {}:\n{}".format(quote.quote_key, get_quote_link(
-            quote.quote_key), quote.from_user.full_name, quote.text or "[No Text Present]"))
-    return header + "\n\n".join(output)
+def show_quote_page(send, entries, page):
+    total = len(db.quotes)
+    send(fmt_quotes(entries, page * quote_page_size, total),
+         reply_markup=quote_page_markup(entries, page, total))
 
 
-btn_list = [[telegram.InlineKeyboardButton("Previous Page", callback_data="lsquotes_previous")], [
-    telegram.InlineKeyboardButton("Next Page", callback_data="lsquotes_next")]]
-markup = telegram.InlineKeyboardMarkup(btn_list)
+def parse_page_cursor(query):
+    try:
+        return [int(i) for i in query.data.split(":")[1:]]
+    except ValueError:
+        return []
 
 
 @check_owner
 @logged
-def lsquotes(bot, update):
-    global ls_quote_sessions
+def lsquotes(bot, update, args):
     msg = update.message
-    key = "{}".format(msg.chat.id)
-    session = {}
-    session['data'] = db["quotes"]
-    session['keys'] = list(session['data'].keys())
-    session['i'] = 0
-    session['di'] = 3
-    if len(session['data']) == 0:
+    page = 0
+    if len(args) != 0 and args[0].isdigit():
+        page = max(int(args[0]) - 1, 0)
+    entries = db.quotes.page_at(page, quote_page_size)
+    if len(entries) == 0:
         msg.reply_text("No quotes found")
         return
-    session['msg'] = msg.reply_text(fmt_quotes(session), reply_markup=markup)
-    if len(ls_quote_sessions) >= 10:
-        ls_quote_sessions = {}
-    ls_quote_sessions[key] = session
+    show_quote_page(msg.reply_text, entries, page)
 
 
 def lsquotes_previous(bot, update):
-    global ls_quote_sessions
     query = update.callback_query
     msg = query.message
-    session_key = "{}".format(msg.chat.id)
-    if session_key not in ls_quote_sessions:
+    cursor = parse_page_cursor(query)
+    if len(cursor) != 2:
         msg.edit_text(
             "Session not found, maybe expired, please /lsquotes again to start a new one.")
         return
-    session = ls_quote_sessions[session_key]
-    i = session['i'] - session['di']
-    if i < 0:
+    entries = db.quotes.page_before(cursor[0], quote_page_size)
+    if len(entries) == 0:
         return
-    session['i'] = i
-    msg.edit_text(fmt_quotes(session), reply_markup=markup)
+    show_quote_page(msg.edit_text, entries, max(cursor[1] - 1, 0))
 
 
 def lsquotes_next(bot, update):
-    global ls_quote_sessions
     query = update.callback_query
     msg = query.message
-    session_key = "{}".format(msg.chat.id)
-    if session_key not in ls_quote_sessions:
+    cursor = parse_page_cursor(query)
+    if len(cursor) != 2:
         msg.edit_text(
             "Session not found, maybe expired, please /lsquotes again to start a new one.")
         return
-    session = ls_quote_sessions[session_key]
-    i = session['i'] + session['di']
-    if i >= len(session['data']):
+    entries = db.quotes.page_after(cursor[0], quote_page_size)
+    if len(entries) == 0:
+        return
+    show_quote_page(msg.edit_text, entries, cursor[1] + 1)
+
+
+def lsquotes_page(bot, update):
+    query = update.callback_query
+    cursor = parse_page_cursor(query)
+    entries = db.quotes.page_at(cursor[0], quote_page_size) if len(cursor) == 1 else []
+    if len(entries) == 0:
+        return
+    show_quote_page(query.message.edit_text, entries, cursor[0])
+
+
+search_sessions = TTLCache(maxsize=256, ttl=3600)
+
+
+def show_search_page(send, text, page):
+    hits, entries = db.quotes.search(text, page, quote_page_size)
+    if len(entries) == 0:
+        return None
+    i = page * quote_page_size
+    # Past hit_cap the count is not known exactly
+    total = "{}+".format(hits) if hits >= db.quotes.hit_cap else hits
+    output = ["Results {}-{} of {} for \"{}\"".format(i + 1, i + len(entries), total, text)]
+    for _, quote in entries:
+        output.append(fmt_quote(quote))
+    btn_list = []
+    if page > 0:
+        btn_list.append(telegram.InlineKeyboardButton(
+            "Previous Page", callback_data="searchquote:{}".format(page - 1)))
+    if i + len(entries) < hits:
+        btn_list.append(telegram.InlineKeyboardButton(
+            "Next Page", callback_data="searchquote:{}".format(page + 1)))
+    return send("\n\n".join(output), reply_markup=telegram.InlineKeyboardMarkup([btn_list]))
+
+
+@logged
+def searchquote(bot, update, args):
+    if len(args) < 1:
+        update.message.reply_text("Usage: /searchquote <terms>")
+        return
+    text = " ".join(args)
+    msg = show_search_page(update.message.reply_text, text, 0)
+    if msg == None:
+        update.message.reply_text("No matching quotes")
         return
-    session['i'] = i
-    msg.edit_text(fmt_quotes(session), reply_markup=markup)
+    search_sessions.set((msg.chat.id, msg.message_id), text)
+
+
+def searchquote_page(bot, update):
+    query = update.callback_query
+    msg = query.message
+    text = search_sessions.get((msg.chat.id, msg.message_id))
+    if text == None:
+        msg.edit_text("Search expired, please /searchquote again.")
+        return
+    show_search_page(msg.edit_text, text, int(query.data.split(":")[1]))
 
 
 def approve_quote(bot, update):
@@ -958,13 +1098,10 @@ def approve_quote(bot, update):
             "Pending quote not found, maybe already processed by another moderator")
         return
     quote = pending_quote[pending_id]
-    quotes = db["quotes"]
-    quotes[quote.quote_key] = quote
-    db["quotes"] = quotes
-    db.sync()
+    db.quotes.add(Quote.from_message(quote.quote_key, quote))
     del pending_quote[pending_id]
-    quote.prompt.edit_text("Approved")
-    msg.edit_text("{}\n\nApproved".format(msg.text))
+    quote.prompt.edit_text("Approved", priority=PRIORITY_HIGH)
+    msg.edit_text("{}\n\nApproved".format(msg.text), priority=PRIORITY_HIGH)
 
 
 def decline_quote(bot, update):
@@ -977,8 +1114,8 @@ def decline_quote(bot, update):
         return
     quote = pending_quote[pending_id]
     del pending_quote[pending_id]
-    quote.prompt.edit_text("Declined")
-    msg.edit_text("{}\n\nDeclined".format(msg.text))
+    quote.prompt.edit_text("Declined", priority=PRIORITY_HIGH)
+    msg.edit_text("{}\n\nDeclined".format(msg.text), priority=PRIORITY_HIGH)
 
 
 def approve_post(bot, update):
@@ -997,8 +1134,8 @@ def approve_post(bot, update):
     post = pending_posts[pending_id]
     bot.forward_message(chan_id, post.chat.id, post.message_id)
     del pending_posts[pending_id]
-    post.prompt.edit_text("Approved")
-    msg.edit_text("{}\n\nApproved".format(msg.text))
+    post.prompt.edit_text("Approved", priority=PRIORITY_HIGH)
+    msg.edit_text("{}\n\nApproved".format(msg.text), priority=PRIORITY_HIGH)
 
 
 def decline_post(bot, update):
@@ -1011,8 +1148,8 @@ def decline_post(bot, update):
         return
     post = pending_posts[pending_id]
     del pending_posts[pending_id]
-    post.prompt.edit_text("Declined")
-    msg.edit_text("{}\n\nDeclined".format(msg.text))
+    post.prompt.edit_text("Declined", priority=PRIORITY_HIGH)
+    msg.edit_text("{}\n\nDeclined".format(msg.text), priority=PRIORITY_HIGH)
 
 
 @check_owner
@@ -1022,35 +1159,16 @@ def rmquote(bot, update, args):
         update.message.reply_text("Usage: /rmquote <quote_id>")
         return
     q_id = args[0]
-    if q_id not in db["quotes"]:
+    if q_id not in db.quotes:
         update.message.reply_text("Quote ID not found")
         return
-    q_dict = db["quotes"]
-    del q_dict[q_id]
-    db["quotes"] = q_dict
-    db.sync()
+    db.quotes.remove(q_id)
     update.message.reply_text("Quote removed")
 
 
 @logged
 def quote(bot, update):
-    while True:
-        keys = list(db["quotes"].keys())
-        if len(keys) == 0:
-            update.message.reply_text("No quotes present")
-            return
-        key = random.choice(keys)
-        gid_to = update.message.chat.id
-        gid_from = db["quotes"][key].chat.id
-        msg_id = db["quotes"][key].message_id
-        try:
-            bot.forward_message(gid_to, gid_from, msg_id)
-            break
-        except telegram.error.BadRequest:
-            q_dict = db["quotes"]
-            del q_dict[key]
-            db["quotes"] = q_dict
-            db.sync()
+    replies.quote(bot, update)
 
 
 def duel(bot, update, real=False):
@@ -1086,20 +1204,15 @@ def duel(bot, update, real=False):
     def duel_expire(bot, job):
         notif.edit_text("决斗邀请已过期")
 
-    queue.run_once(duel_expire, 300)
-
-
-real_duel_cd = {}
+    run_in_chat(msg.chat.id, duel_expire, 300)
 
 
 def real_duel(bot, update):
-    global real_duel_cd
     gid = update.message.chat.id
     uid = update.message.from_user.id
-    if gid not in real_duel_cd:
-        real_duel_cd[gid] = {}
-    if uid in real_duel_cd[gid]:
-        remaining = real_duel_cd[gid][uid].est_cd - datetime.datetime.now()
+    cd_left = timers.remaining("duel_cd", "{}_{}".format(gid, uid))
+    if cd_left != None:
+        remaining = datetime.timedelta(seconds=int(cd_left))
         update.message.reply_text(
             "此命令仍在冷却状态，你不能使用\n预计剩余冷却时间: {}".format(remaining))
         return
@@ -1114,8 +1227,8 @@ def handle_decline_duel(bot, update):
     payload = query.data.split(":")[1]
     from_user_id = int(payload.split(",")[0])
     to_user_id = int(payload.split(",")[1])
-    from_user = chat.get_member(from_user_id).user
-    to_user = chat.get_member(to_user_id).user
+    from_user = member_cache.get(bot, chat.id, from_user_id).user
+    to_user = member_cache.get(bot, chat.id, to_user_id).user
 
     if query.from_user.id == to_user_id:
         msg.edit_text("{} 拒绝了决斗".format(
@@ -1136,10 +1249,9 @@ def handle_duel(bot, update, real=False):
     from_user_id = int(payload.split(",")[0])
     to_user_id = int(payload.split(",")[1])
 
+    cd_key = "{}_{}".format(chat.id, from_user_id)
     if real:
-        if chat.id not in real_duel_cd:
-            real_duel_cd[chat.id] = {}
-        if from_user_id in real_duel_cd[chat.id]:
+        if timers.remaining("duel_cd", cd_key) != None:
             msg.edit_text("发起者的决斗处于冷却中，此项决斗无效")
             return
 
@@ -1147,17 +1259,12 @@ def handle_duel(bot, update, real=False):
         query.answer("没有找你决斗，别凑热闹啦", show_alert=True)
         return
 
-    from_user = chat.get_member(from_user_id).user
-    to_user = chat.get_member(to_user_id).user
+    from_user = member_cache.get(bot, chat.id, from_user_id).user
+    to_user = member_cache.get(bot, chat.id, to_user_id).user
 
     if real:
-        def remove_event(bot, job):
-            del real_duel_cd[chat.id][from_user_id]
-
-        cd_time = 43200
-        event = queue.run_once(remove_event, cd_time)
-        event.est_cd = datetime.datetime.now() + datetime.timedelta(seconds=cd_time)
-        real_duel_cd[chat.id][from_user_id] = event
+        # Duel cooldowns have no handler, the timer row just expires
+        timers.schedule("duel_cd", cd_key, 43200, chat_id=chat.id)
 
     from_user_text = from_user.full_name
     to_user_text = to_user.full_name
@@ -1173,21 +1280,6 @@ def handle_duel(bot, update, real=False):
     round_time = 5
     ban_time = "10m"
 
-    def generate_damage_text(from_user_text, to_user_text, damage):
-        abs_damage = abs(damage)
-        damage_distribute = [5, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2,
-                             1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-        skill_text = ['跃起', '瞪眼', '摇尾巴', '叫声', '王八拳', '掷泥', '飞弹针', '种子机关枪', '二连踢', '啄', '拍击', '抓', '撞击', '火花', '水枪', '电击', '泡沫', '细雪', '音速拳', '龙卷风', '碎岩', '真空波', '子弹拳', '冰砾', '水流喷射', '酸液炸弹', '妖精之风', '树叶', '藤鞭', '齿轮飞盘', '骨头回力镖', '充电光束', '居合斩', '金属爪', '空手劈', '念力', '剧毒牙', '毒尾', '蓄能焰袭', '飞叶快刀', '冰冻之风', '泥巴射击', '回旋踢', '冰息', '龙尾', '空气利刃', '岩石封锁', '翅膀攻击', '火焰轮', '龙息', '银色旋风', '水之波动', '雪崩', '烧尽', '重踏', '狂舞挥打', '高速星星', '暗影拳', '燕返', '魔法叶', '电击波', '磁铁炸弹', '泥巴炸弹', '雷电牙', '冰冻牙', '火焰牙', '幻象光线', '泡沫光线', '极光束', '污泥攻击', '电光', '拍落', '毒液冲击', '下盘踢', '钢翼', '头锤', '暗影爪', '十字毒刃', '冷冻干燥', '岩崩', '空气斩', '火焰拳',
-                      '冰冻拳', '雷电拳', '劈瓦', '信号光束', '魔法火焰', '地狱翻滚', '百万吨重拳', '旋风刀', '啄钻', '怪力', '挖洞', '攀瀑', '咬碎', '暗影球', '潜水', '龙爪', '毒击', '恶之波动', '种子炸弹', '十字剪', '加农光炮', '铁头', '热水', '魔法闪耀', '火焰鞭', '波导弹', '火焰踢', '冰柱坠击', '龙之波动', '猛撞', '攀岩', '喷射火焰', '冲浪', '冰冻光束', '十万伏特', '精神强念', '污泥炸弹', '巨声', '叶刃', '虫鸣', '能量球', '疯狂伏特', '花粉团', '热风', '十万马力', '月亮之力', '爆裂拳', '铁尾', '龙之俯冲', '熔岩风暴', '十字劈', '冰锤', '飞踢', '气旋攻击', '地震', '交错火焰', '交错闪电', '暴风雪', '打雷', '暴风', '水炮', '大字爆炎', '根源波动', '蒸汽爆炸', '电磁炮', '真气弹', '百万吨重踢', '舍身冲撞', '日光束', '逆鳞', '近身战', '勇鸟猛攻', '画龙点睛', '流星群', '飞叶风暴', '花朵加农炮', '冰冻伏特', '破灭之光', '破坏光线', '终极冲击', '大爆炸']
-        skill = random.choice(skill_text[sum(damage_distribute[0:abs_damage]):sum(
-            damage_distribute[0:abs_damage]) + damage_distribute[abs_damage]])
-        if damage > 0:
-            return "{} 使用了{}，对 {} 造成了{}点伤害！".format(from_user_text, skill, to_user_text, abs_damage)
-        elif damage < 0:
-            return "{} 使用了{}，对 {} 造成了{}点伤害！".format(to_user_text, skill, from_user_text, abs_damage)
-        else:
-            return "{} 和 {} 互相使用了{}，什么事都没有发生！".format(from_user_text, to_user_text, skill)
-
     def process_duel(bot, job):
         nonlocal from_user_hp, to_user_hp, rnd
         from_user_point = random.randrange(1, 101)
@@ -1205,7 +1297,8 @@ def handle_duel(bot, update, real=False):
             from_user_hp, from_user_text, to_user_hp, to_user_text)
         rnd_text = "第{}轮：\n\n{}\n\n{}\n\n{}".format(
             rnd, roll_text, damage_text, hp_text)
-        duel_msg.edit_text(rnd_text, parse_mode="Markdown")
+        duel_msg.edit_text(rnd_text, parse_mode="Markdown",
+                           priority=PRIORITY_LOW)
         if from_user_hp <= 0:
             duel_msg.reply_text("{}被打败了，决斗结束".format(
                 from_user.mention_markdown()), parse_mode="Markdown")
@@ -1219,87 +1312,283 @@ def handle_duel(bot, update, real=False):
                 ban_user(bot, chat, to_user, ban_time)
             return
         rnd += 1
-        queue.run_once(process_duel, round_time)
+        run_in_chat(chat.id, process_duel, round_time)
 
-    queue.run_once(process_duel, round_time)
+    run_in_chat(chat.id, process_duel, round_time)
 
 
 def handle_real_duel(bot, update):
     handle_duel(bot, update, True)
 
 
-updater.dispatcher.add_handler(CommandHandler("start", start))
-updater.dispatcher.add_handler(CommandHandler("getgid", getgid))
-updater.dispatcher.add_handler(
-    CommandHandler("settitle", settitle, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("resettitle", resettitle))
-updater.dispatcher.add_handler(CommandHandler("setpic", setpic))
-updater.dispatcher.add_handler(CommandHandler("pin", pin, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("unpin", unpin))
-updater.dispatcher.add_handler(CommandHandler("help", list_cmd))
-updater.dispatcher.add_handler(CommandHandler("actions", list_act))
-updater.dispatcher.add_handler(CommandHandler("getsid", getsid))
-updater.dispatcher.add_handler(CommandHandler("getuid", getuid))
-updater.dispatcher.add_handler(CommandHandler("postit", postit))
-updater.dispatcher.add_handler(CommandHandler("addquote", addquote))
-updater.dispatcher.add_handler(CommandHandler("quote", quote))
-updater.dispatcher.add_handler(CommandHandler("lsquotes", lsquotes))
-updater.dispatcher.add_handler(
-    CommandHandler("rmquote", rmquote, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("duel", duel))
-updater.dispatcher.add_handler(CommandHandler("real_duel", real_duel))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    lsquotes_previous, pattern="lsquotes_previous"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    lsquotes_next, pattern="lsquotes_next"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    approve_quote, pattern=r"approve_quote:.*"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    decline_quote, pattern=r"decline_quote:.*"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    approve_post, pattern=r"approve_post:.*"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    decline_post, pattern=r"decline_post:.*"))
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(handle_duel, pattern=r"duel:.*"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    handle_real_duel, pattern=r"real_duel:.*"))
-updater.dispatcher.add_handler(CallbackQueryHandler(
-    handle_decline_duel, pattern=r"decline_duel:.*"))
-updater.dispatcher.add_handler(
-    CommandHandler("setsres", setsres, pass_args=True))
-updater.dispatcher.add_handler(
-    CommandHandler("delsres", delsres, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("lssres", lssres))
-updater.dispatcher.add_handler(
-    CommandHandler("settres", settres, pass_args=True))
-updater.dispatcher.add_handler(
-    CommandHandler("deltres", deltres, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("ban", ban, pass_args=True))
-updater.dispatcher.add_handler(
-    CommandHandler("banpic", banpic, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("unban", unban))
-updater.dispatcher.add_handler(CommandHandler("lstres", lstres))
-updater.dispatcher.add_handler(CommandHandler("shows", shows, pass_args=True))
-updater.dispatcher.add_handler(CommandHandler("stock", stock, pass_args=True))
-
-updater.dispatcher.add_handler(
-    MessageHandler(Filters.sticker, sticker_response))
-updater.job_queue.run_repeating(callback_poll_member, interval=5, first=0)
-updater.job_queue.run_repeating(callback_poll_count, interval=5, first=0)
-
-for key in actions:
-    fact = action_gen(**actions[key])
-    updater.dispatcher.add_handler(CommandHandler(key, fact))
-for regex in db["text_response"]:
-    response = db["text_response"][regex]
-    h = RegexHandler(regex, generate_reghandler(response))
-    updater.dispatcher.add_handler(h)
-    regex_handlers[regex] = h
-updater.dispatcher.add_handler(
-    MessageHandler(Filters.all, log_user_id))
-
-updater.start_webhook(listen='127.0.0.1', port=9990, url_path="/ai/" + tg_key)
-updater.bot.set_webhook(url='https://tgbot.chaserhkj.me/ai/' + tg_key)
-updater.idle()
-db.close()
+text_response_handler = MessageHandler(
+    Filters.text | Filters.command, text_response, channel_post_updates=False)
+action_handlers = {}
+# Settings a reload applies, changes to the others need a restart
+RELOADABLE = ("groups", "watches", "quote_moderator", "quote_page_size")
+reload_lock = threading.Lock()
+
+
+def diff_keys(old, new):
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = [k for k in new if k in old and new[k] != old[k]]
+    return added, removed, changed
+
+
+def action_keywords(actions):
+    return set(search_keyword(a["keyword"], a.get("anime", True)) for a in actions.values())
+
+
+def apply_actions(old, new):
+    # Action commands sit before the text trigger handler, which would
+    # take them otherwise. The group's list is swapped whole, so updates
+    # being dispatched meanwhile see either the old or the new one.
+    added, removed, changed = diff_keys(old, new)
+    handlers = list(updater.dispatcher.handlers[0])
+    for key in removed:
+        handlers.remove(action_handlers.pop(key))
+    for key in changed + added:
+        handler = metrics.instrument_handler(CommandHandler(key, action_gen(**new[key])))
+        if key in action_handlers:
+            handlers[handlers.index(action_handlers[key])] = handler
+        else:
+            handlers.insert(handlers.index(text_response_handler), handler)
+        action_handlers[key] = handler
+    updater.dispatcher.handlers[0] = handlers
+    old_keywords, new_keywords = action_keywords(old), action_keywords(new)
+    for keyword in new_keywords - old_keywords:
+        gif_pool.watch(keyword)
+    for keyword in old_keywords - new_keywords:
+        gif_pool.unwatch(keyword)
+    return added, removed, changed
+
+
+def flat_member_watches(watches):
+    return dict(((gid, uid), watch) for gid in watches for uid, watch in watches[gid].items())
+
+
+def reload_config():
+    # Applies what changed in config.yaml and actions.yaml while the bot
+    # keeps serving. Watches that did not change keep their state.
+    global actions, group_config, count_watches, member_watches, quote_moderator, \
+        quote_page_size, config_mtimes
+    with reload_lock:
+        config_mtimes = config_file_mtimes()
+        new_config = configfile.load(config_path)
+        new_actions = configfile.load(action_path)["actions"]
+        new_groups = new_config["groups"]
+        new_count = new_config["watches"]["count"]
+        new_member = new_config["watches"]["member"]
+
+        summary = []
+
+        def report(name, diff):
+            summary.append("{}: {} added, {} removed, {} changed".format(
+                name, len(diff[0]), len(diff[1]), len(diff[2])))
+
+        report("Actions", apply_actions(actions, new_actions))
+        actions = new_actions
+        report("Groups", diff_keys(group_config, new_groups))
+        group_config = new_groups
+
+        diff = diff_keys(count_watches, new_count)
+        count_watches = new_count
+        for gid in diff[1]:
+            old_member_count.pop(gid, None)
+        report("Count watches", diff)
+
+        diff = diff_keys(flat_member_watches(member_watches), flat_member_watches(new_member))
+        member_watches = new_member
+        for key in diff[1]:
+            member_scheduler.remove(key)
+            old_status.pop("{}_{}".format(*key), None)
+        for key in diff[0]:
+            if owns(key[0]):
+                member_scheduler.add(key)
+        report("Member watches", diff)
+
+        quote_moderator = [owner] + new_config.get("quote_moderator", [])
+        quote_page_size = new_config.get("quote_page_size", 3)
+        restart = sorted(k for k in set(config) | set(new_config)
+                         if k not in RELOADABLE and config.get(k) != new_config.get(k))
+        config.update((k, new_config[k]) for k in RELOADABLE if k in new_config)
+        if len(restart) != 0:
+            summary.append("Needs a restart: {}".format(", ".join(restart)))
+        return "\n".join(summary)
+
+
+@check_owner
+@logged
+def reload(bot, update):
+    # Only reloads this worker when sharded, the others follow the file
+    # change through reload_changed_config
+    update.message.reply_text(reload_config())
+
+
+def reload_changed_config(bot, job):
+    try:
+        if config_file_mtimes() == config_mtimes:
+            return
+        summary = reload_config()
+    except Exception:
+        logging.getLogger().exception("Reloading config failed")
+        return
+    logging.getLogger().info("Reloaded config: %s", summary.replace("\n", "; "))
+
+
+def run_job(name, callback, interval, first):
+    updater.job_queue.run_repeating(metrics.timed("aibot_job", callback, job=name),
+                                    interval=interval, first=first, name=name)
+
+
+def setup():
+    # Runs once the webhook listens, so Telegram's deliveries queue up
+    # instead of failing while the handlers are registered and caches warmed
+    global text_response_version
+    updater.dispatcher.add_handler(CommandHandler("start", start))
+    updater.dispatcher.add_handler(CommandHandler("getgid", getgid))
+    updater.dispatcher.add_handler(
+        CommandHandler("settitle", settitle, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("resettitle", resettitle))
+    updater.dispatcher.add_handler(CommandHandler("setpic", setpic))
+    updater.dispatcher.add_handler(CommandHandler("pin", pin, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("unpin", unpin))
+    updater.dispatcher.add_handler(CommandHandler("help", list_cmd))
+    updater.dispatcher.add_handler(CommandHandler("actions", list_act))
+    updater.dispatcher.add_handler(CommandHandler("getsid", getsid))
+    updater.dispatcher.add_handler(CommandHandler("getuid", getuid))
+    updater.dispatcher.add_handler(CommandHandler("postit", postit))
+    updater.dispatcher.add_handler(CommandHandler("addquote", addquote))
+    updater.dispatcher.add_handler(CommandHandler("quote", quote))
+    updater.dispatcher.add_handler(
+        CommandHandler("lsquotes", lsquotes, pass_args=True))
+    updater.dispatcher.add_handler(
+        CommandHandler("rmquote", rmquote, pass_args=True))
+    updater.dispatcher.add_handler(
+        CommandHandler("searchquote", searchquote, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("duel", duel))
+    updater.dispatcher.add_handler(CommandHandler("real_duel", real_duel))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        lsquotes_previous, pattern="lsquotes_previous"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        lsquotes_next, pattern="lsquotes_next"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        lsquotes_page, pattern=r"lsquotes_page:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        searchquote_page, pattern=r"searchquote:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        approve_quote, pattern=r"approve_quote:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        decline_quote, pattern=r"decline_quote:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        approve_post, pattern=r"approve_post:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        decline_post, pattern=r"decline_post:.*"))
+    updater.dispatcher.add_handler(
+        CallbackQueryHandler(handle_duel, pattern=r"duel:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        handle_real_duel, pattern=r"real_duel:.*"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(
+        handle_decline_duel, pattern=r"decline_duel:.*"))
+    updater.dispatcher.add_handler(
+        CommandHandler("setsres", setsres, pass_args=True))
+    updater.dispatcher.add_handler(
+        CommandHandler("delsres", delsres, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("lssres", lssres))
+    updater.dispatcher.add_handler(
+        CommandHandler("settres", settres, pass_args=True))
+    updater.dispatcher.add_handler(
+        CommandHandler("deltres", deltres, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("ban", ban, pass_args=True))
+    updater.dispatcher.add_handler(
+        CommandHandler("banpic", banpic, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("unban", unban))
+    updater.dispatcher.add_handler(CommandHandler("lstres", lstres))
+    updater.dispatcher.add_handler(CommandHandler("shows", shows, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("stock", stock, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler("stats", stats))
+    updater.dispatcher.add_handler(CommandHandler("reload", reload))
+
+    updater.dispatcher.add_handler(
+        MessageHandler(Filters.sticker, sticker_response))
+    updater.dispatcher.add_handler(
+        TypeHandler(telegram.Update, observe_chats), group=-1)
+
+    run_job("member_watches", member_scheduler.tick, interval=1, first=0)
+    run_job("timers", timers.tick, interval=1, first=0)
+    run_job("chat_meta", chat_meta.refresh, interval=600, first=600)
+    run_job("count_watches", callback_poll_count, interval=5, first=0)
+    if shard_count > 1:
+        run_job("text_responses", reload_text_responses, interval=5, first=5)
+
+    reload_interval = config.get("reload_interval", 10)
+    if reload_interval:
+        run_job("config_files", reload_changed_config, interval=reload_interval,
+                first=reload_interval)
+
+    text_response_version = db.meta.get("text_response_version")
+    text_matcher.load(db.text_response.items())
+    updater.dispatcher.add_handler(text_response_handler)
+    updater.dispatcher.add_handler(
+        MessageHandler(Filters.all, log_user_id))
+    apply_actions({}, actions)
+    metrics.instrument(updater.dispatcher)
+    ready.set()
+    mark_startup("ready")
+
+
+metrics.describe("aibot_handler_seconds", "Handler callback latency")
+metrics.describe("aibot_update_seconds", "Update latency from arrival, including the wait behind its chat")
+metrics.describe("aibot_upstream_seconds", "Tenor and Yahoo calls including retries")
+metrics.describe("aibot_telegram_seconds", "Bot API calls made by the send queue")
+metrics.describe("aibot_send_queue_wait_seconds", "Time outgoing calls waited for rate limits")
+metrics.collect("aibot_send_queue", send_queue.stats)
+metrics.collect("aibot_chat_executor", chat_executor.stats)
+metrics.collect("aibot_member_watches", member_scheduler.stats)
+metrics.collect("aibot_member_cache", member_cache.stats)
+metrics.collect("aibot_stock_cache", stock_quotes.stats)
+metrics.collect("aibot_log", lambda: {"dropped": log_handler.dropped})
+metrics.collect("aibot_startup_seconds", lambda: startup)
+mark_startup("loaded")
+
+async_webhook = None
+
+
+def main():
+    global async_webhook
+    url_path = "/ai/" + tg_key
+    metrics_config = config.get("metrics", {})
+    if metrics_config.get("enabled", True):
+        MetricsServer(metrics, metrics_config.get("listen", '127.0.0.1'),
+                      metrics_config.get("port", 9180) + shard_index).start()
+
+    def serving():
+        mark_startup("listening")
+        setup()
+        if shard_index == 0:
+            updater.bot.set_webhook(url=webhook_url + url_path, allowed_updates=ALLOWED_UPDATES)
+
+    if config.get("run_mode", "webhook") != "webhook":
+        logging.getLogger().warning("run_mode %s is no longer supported, using the webhook",
+                                    config["run_mode"])
+    if shard_count > 1:
+        # Worker process behind shard.py, which owns the public webhook and
+        # pipelines updates to us over a kept-alive connection
+        async_webhook = AsyncWebhook(updater.bot, '127.0.0.1', int(os.environ["AIBOT_PORT"]),
+                                     url_path, dispatch_by_chat, on_started=serving,
+                                     update_class=MemberUpdate,
+                                     max_pending=config.get("sharding", {}).get("max_pending", 10000))
+        updater.job_queue.start()
+        async_webhook.run()
+        updater.job_queue.stop()
+    else:
+        updater.start_webhook(listen=webhook_listen, port=webhook_port, url_path=url_path)
+        serving()
+        updater.idle()
+    db.close()
+    log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
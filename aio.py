@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import signal
+import threading
+
+import telegram
+
+RESPONSES = {
+    200: b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",
+    400: b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n",
+    403: b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n\r\n",
+    503: b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n",
+}
+
+
+class WebhookListener(object):
+    # Minimal HTTP/1.1 server for Telegram's webhook posts, subclasses
+    # decide what happens to an accepted body in _accept.
+    def __init__(self, listen, port, url_path):
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path
+        self.logger = logging.getLogger(__name__)
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, headers, body
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request == None:
+                    break
+                method, path, headers, body = request
+                status = self._accept(method, path, body)
+                writer.write(RESPONSES[status])
+                await writer.drain()
+                # Nothing pipelined behind a refused update is taken either,
+                # the sender retries them all in their order
+                if status == 503 or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Open connections are cancelled when the server shuts down
+            pass
+        finally:
+            writer.close()
+
+    def _accept(self, method, path, body):
+        raise NotImplementedError
+
+    async def _started(self):
+        pass
+
+    def _stopped(self):
+        pass
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        stop = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set_result, None)
+        server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        self.logger.info("Listening for updates on %s:%d (asyncio)", self.listen, self.port)
+        await self._started()
+        async with server:
+            await stop
+        self._stopped()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+class AsyncWebhook(WebhookListener):
+    # Listener of a sharded worker. It answers 503 past max_pending updates
+    # so the router holds and resends them in order. Handlers run wherever
+    # submit puts them, this adds no concurrency of its own.
+    def __init__(self, bot, listen, port, url_path, submit, max_pending=10000,
+                 on_started=None, update_class=telegram.Update):
+        super(AsyncWebhook, self).__init__(listen, port, url_path)
+        self.bot = bot
+        # submit(update) runs the update elsewhere and returns a concurrent Future
+        self.submit = submit
+        # on_started() runs on a thread of its own once the socket listens
+        self.on_started = on_started
+        self.update_class = update_class
+        self.max_pending = max_pending
+        self.pending = 0
+        self.processed = 0
+
+    def _accept(self, method, path, body):
+        if method != "POST" or path != self.url_path:
+            return 403
+        if self.pending >= self.max_pending:
+            # Telegram redelivers the update later
+            return 503
+        try:
+            update = self.update_class.de_json(json.loads(body.decode("utf-8")), self.bot)
+        except ValueError:
+            return 400
+        self.pending += 1
+        # Submitted here rather than in the task, so updates of a connection
+        # are submitted in the order they arrived
+        asyncio.ensure_future(self._process(update, self.submit(update)))
+        return 200
+
+    async def _process(self, update, future):
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            self.logger.exception("Processing update %s failed", update.update_id)
+        finally:
+            self.pending -= 1
+            self.processed += 1
+
+    async def _started(self):
+        if self.on_started != None:
+            threading.Thread(target=self.on_started, name="on_started", daemon=True).start()
+
+    def stats(self):
+        return {"pending": self.pending, "processed": self.processed}
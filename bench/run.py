@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Microbenchmarks of the per-update hot paths, no network needed: the bot
+# and updates are stubs. Results go to a JSON file, --compare prints the
+# change against an earlier one.
+#
+#     python3 bench/run.py -o bench.json
+#     python3 bench/run.py -o new.json --compare bench.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from matcher import TextMatcher  # noqa: E402
+from replies import Replies  # noqa: E402
+from storage import Store, Quote  # noqa: E402
+from texts import fmt_quotes, generate_damage_text  # noqa: E402
+from timers import TimerStore  # noqa: E402
+
+Case = namedtuple("Case", "name setup")
+Chat = namedtuple("Chat", "id")
+User = namedtuple("User", "id username")
+Sticker = namedtuple("Sticker", "file_id")
+QUOTE_SIZES = (10, 1000, 100000)
+WORDS = ("hello", "world", "bot", "quote", "duel", "hug", "sticker", "群", "你好", "早上好",
+         "晚安", "哈哈哈", "草", "awsl", "yyds", "ping", "pong", "test")
+
+
+def timeit(func, repeat, min_time):
+    # Calibrate the batch size to take min_time, then time repeat batches
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time:
+            break
+        number *= 2
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - start) / number)
+    runs.sort()
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_us": runs[0] * 1e6,
+        "median_us": runs[len(runs) // 2] * 1e6,
+        "max_us": runs[-1] * 1e6,
+    }
+
+
+class StubMessage(object):
+    def __init__(self, text=None, sticker=None, uid=1, username="user"):
+        self.message_id = 1
+        self.chat = Chat(-100123)
+        self.from_user = User(uid, username)
+        self.text = text
+        self.sticker = None if sticker == None else Sticker(sticker)
+
+    def reply_text(self, text, **kwargs):
+        pass
+
+    def reply_sticker(self, sticker, **kwargs):
+        pass
+
+
+class StubUpdate(object):
+    def __init__(self, message):
+        self.message = message
+
+
+class StubBot(object):
+    def forward_message(self, chat_id, from_chat_id, message_id):
+        pass
+
+
+def sentence(rng, n=8):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def open_store(tmp):
+    return Store(os.path.join(tmp, "bench_{}.sqlite3".format(random.random())))
+
+
+def make_replies(db, matcher=None, log_uid=True):
+    groups = {-100123: {"log_uid": log_uid}}
+    return Replies(db, matcher or TextMatcher(), lambda gid, key: groups.get(gid, {}).get(key),
+                   lambda *argl: None, TimerStore(db))
+
+
+def text_matching(tmp, triggers, flags="(?i)"):
+    # With "(?i)" every trigger carries a global flag, without it they are
+    # plain ^word$ patterns
+    rng = random.Random(1)
+    matcher = TextMatcher()
+    matcher.load([("{}^{}{}$".format(flags, rng.choice(WORDS), i),
+                   (1, 0, "text", "reply {}".format(i))) for i in range(triggers - 1)] +
+                 [("哈哈哈$", (1, 0, "text", "hit"))])
+    messages = [sentence(rng) for _ in range(256)]
+    matcher.match(messages[0])
+    it = iter(range(1 << 62))
+    return lambda: matcher.match(messages[next(it) & 255])
+
+
+def text_response(tmp):
+    # Replies.text_response with 500 triggers, logging ids and answering
+    rng = random.Random(2)
+    db = open_store(tmp)
+    matcher = TextMatcher()
+    matcher.load([("^{}{}$".format(rng.choice(WORDS), i), (1, 0, "text", "reply {}".format(i)))
+                  for i in range(499)] + [(".*哈哈哈", (1, 0, "text", "hit"))])
+    replies = make_replies(db, matcher)
+    updates = [StubUpdate(StubMessage(text=sentence(rng), uid=i, username="user_{}".format(i)))
+               for i in range(256)]
+    bot = StubBot()
+    it = iter(range(1 << 62))
+    return lambda: replies.text_response(bot, updates[next(it) & 255])
+
+
+def sticker_response(tmp):
+    # Half of the stickers have a response
+    db = open_store(tmp)
+    with db.transaction():
+        for i in range(500):
+            db.sticker_response["sticker_{}".format(i)] = (1, 0, "text", "reply")
+    replies = make_replies(db)
+    updates = [StubUpdate(StubMessage(sticker="sticker_{}".format(i * 2), uid=i,
+                                      username="user_{}".format(i))) for i in range(500)]
+    bot = StubBot()
+    it = iter(range(1 << 62))
+    return lambda: replies.sticker_response(bot, updates[next(it) % 500])
+
+
+def log_user_id(tmp):
+    db = open_store(tmp)
+    replies = make_replies(db)
+    updates = [StubUpdate(StubMessage(uid=i, username="user_{}".format(i))) for i in range(2000)]
+    it = iter(range(1 << 62))
+    return lambda: replies.log_user_id(updates[next(it) % 2000])
+
+
+def respond_cooldown(tmp):
+    # Replies.respond over 5000 responses with a cooldown, most calls
+    # find their response cooling down
+    replies = make_replies(open_store(tmp))
+    responses = [(1, 30, "text", "reply {}".format(i)) for i in range(5000)]
+    update = StubUpdate(StubMessage(text="hi"))
+    bot = StubBot()
+    it = iter(range(1 << 62))
+    return lambda: replies.respond(bot, update, responses[next(it) % 5000])
+
+
+def fill_quotes(db, n):
+    rng = random.Random(n)
+    with db.transaction():
+        for i in range(n):
+            db.quotes.add(Quote("-100123_{}".format(i), -100123, i, "user {}".format(i % 50),
+                                sentence(rng, 12), time.time()))
+
+
+def quote_pages(tmp):
+    db = open_store(tmp)
+    fill_quotes(db, 1000)
+    total = len(db.quotes)
+    it = iter(range(1 << 62))
+
+    def page():
+        p = next(it) % 300
+        return fmt_quotes(db.quotes.page_at(p, 3), p * 3, total)
+    return page
+
+
+def quote_random(n):
+    # /quote: a random pick and the forward of a stub bot
+    def setup(tmp):
+        db = open_store(tmp)
+        fill_quotes(db, n)
+        replies = make_replies(db)
+        update = StubUpdate(StubMessage(text="/quote"))
+        bot = StubBot()
+        return lambda: replies.quote(bot, update)
+    return setup
+
+
+def quote_search(n):
+    # /searchquote over terms in about half the quotes, alone and next
+    # to a rarer author term
+    def setup(tmp):
+        db = open_store(tmp)
+        fill_quotes(db, n)
+        queries = ("hello", "hello world", "你好 早上好", "duel 7", "user 7")
+        it = iter(range(1 << 62))
+
+        def search():
+            i = next(it)
+            return db.quotes.search(queries[i % len(queries)], i % 3, 3)
+        return search
+    return setup
+
+
+def damage_text(tmp):
+    it = iter(range(1 << 62))
+    return lambda: generate_damage_text("Alice", "Bob", next(it) % 199 - 99)
+
+
+def cases(quick):
+    yield Case("text_matching_50", lambda tmp: text_matching(tmp, 50))
+    yield Case("text_matching_500", lambda tmp: text_matching(tmp, 500))
+    for n in (50, 500, 5000):
+        yield Case("text_matching_plain_{}".format(n), lambda tmp, n=n: text_matching(tmp, n, ""))
+    yield Case("text_response", text_response)
+    yield Case("sticker_response_lookup", sticker_response)
+    yield Case("log_user_id_write", log_user_id)
+    yield Case("respond_cooldown", respond_cooldown)
+    yield Case("fmt_quotes_page", quote_pages)
+    for n in QUOTE_SIZES:
+        if quick and n > 1000:
+            continue
+        yield Case("quote_random_{}".format(n), quote_random(n))
+        yield Case("quote_search_{}".format(n), quote_search(n))
+    yield Case("generate_damage_text", damage_text)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path, "r") as f:
+        old = json.load(f)["results"]
+    for name, new in results.items():
+        if name not in old:
+            continue
+        ratio = new["median_us"] / old[name]["median_us"]
+        print("{:<28} {:>10.2f}us -> {:>10.2f}us  {:>+6.1f}%".format(
+            name, old[name]["median_us"], new["median_us"], (ratio - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="bench.json")
+    parser.add_argument("-k", "--filter", default="", help="Only run cases containing this")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.05)
+    parser.add_argument("--quick", action="store_true", help="Skip the 100k quote case")
+    parser.add_argument("--compare", help="Earlier results file to compare with")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="aibot_bench")
+    results = {}
+    try:
+        for case in cases(args.quick):
+            if args.filter not in case.name:
+                continue
+            func = case.setup(tmp)
+            results[case.name] = timeit(func, args.repeat, args.min_time)
+            print("{:<28} {:>10.2f}us".format(case.name, results[case.name]["median_us"]))
+    finally:
+        shutil.rmtree(tmp)
+    with open(args.output, "w") as f:
+        json.dump({
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_missing = object()
+
+
+class TTLCache(object):
+    # Entries expire lazily when touched or when they reach the LRU end,
+    # and the least recently used one is evicted past maxsize.
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def _lookup(self, key, now):
+        item = self.data.get(key, _missing)
+        if item is _missing:
+            return _missing
+        if item[0] <= now:
+            del self.data[key]
+            return _missing
+        self.data.move_to_end(key)
+        return item[1]
+
+    def _store(self, key, value, ttl, now):
+        self.data[key] = (now + (self.ttl if ttl == None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        # Sweep a few stale entries from the cold end on every write
+        for _ in range(4):
+            oldest = next(iter(self.data.items()), None)
+            if oldest == None or oldest[1][0] > now:
+                break
+            del self.data[oldest[0]]
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._lookup(key, time.monotonic())
+        return default if value is _missing else value
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._lookup(key, time.monotonic()) is not _missing
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._store(key, value, ttl, time.monotonic())
+
+    def add(self, key, value=True, ttl=None):
+        with self.lock:
+            now = time.monotonic()
+            if self._lookup(key, now) is not _missing:
+                return False
+            self._store(key, value, ttl, now)
+            return True
+
+    def setdefault(self, key, factory, ttl=None):
+        with self.lock:
+            now = time.monotonic()
+            value = self._lookup(key, now)
+            if value is _missing:
+                value = factory()
+                self._store(key, value, ttl, now)
+            return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, _missing)
+        if item is _missing or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def keys(self):
+        with self.lock:
+            now = time.monotonic()
+            return [key for key, item in self.data.items() if item[0] > now]
+
+    def prune(self, predicate):
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+
+class SingleFlight(object):
+    # Concurrent calls for the same key wait on the first caller's result
+    # instead of each going upstream.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, func):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future == None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
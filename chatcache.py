@@ -0,0 +1,121 @@
+import logging
+from collections import namedtuple
+
+import telegram
+
+from cache import TTLCache
+
+MEMBER_UPDATES = ("chat_member", "my_chat_member")
+ChatMemberUpdated = namedtuple("ChatMemberUpdated", "chat old_chat_member new_chat_member")
+
+
+class MemberUpdate(telegram.Update):
+    # PTB 11 predates chat_member and my_chat_member updates and drops them
+    # while parsing, this keeps them as ChatMemberUpdated tuples. They only
+    # arrive when set_webhook asks for them in allowed_updates.
+    @classmethod
+    def de_json(cls, data, bot):
+        update = super(MemberUpdate, cls).de_json(data, bot)
+        if update == None:
+            return None
+        for kind in MEMBER_UPDATES:
+            changed = data.get(kind)
+            setattr(update, kind, None if changed == None else ChatMemberUpdated(
+                telegram.Chat.de_json(changed["chat"], bot),
+                telegram.ChatMember.de_json(changed["old_chat_member"], bot),
+                telegram.ChatMember.de_json(changed["new_chat_member"], bot)))
+        return update
+
+
+class MemberCache(object):
+    # Short-lived ChatMember lookups shared by the permission checks and the
+    # moderation commands. Membership changes we can see drop the entry early.
+    def __init__(self, ttl=30, maxsize=10000):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bot, gid, uid):
+        member = self.cache.get((gid, uid))
+        if member != None:
+            self.hits += 1
+            return member
+        self.misses += 1
+        member = bot.get_chat_member(gid, uid)
+        self.cache.set((gid, uid), member)
+        return member
+
+    def invalidate(self, gid, uid=None):
+        if uid == None:
+            self.cache.prune(lambda key: key[0] == gid)
+        else:
+            self.cache.pop((gid, uid))
+
+    def observe(self, update):
+        msg = update.message
+        if msg != None:
+            for user in msg.new_chat_members or []:
+                self.invalidate(msg.chat.id, user.id)
+            if msg.left_chat_member != None:
+                self.invalidate(msg.chat.id, msg.left_chat_member.id)
+        # chat_member / my_chat_member updates, see MemberUpdate
+        for changed in (getattr(update, "chat_member", None), getattr(update, "my_chat_member", None)):
+            if changed != None:
+                self.invalidate(changed.chat.id, changed.new_chat_member.user.id)
+
+    def stats(self):
+        return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+class ChatMetaCache(object):
+    # Chat titles, channel admin lists and the bot's own User. Known entries
+    # are refreshed by a background job before they expire, and title or
+    # admin changes seen in updates replace them right away.
+    def __init__(self, ttl=3600, maxsize=1000):
+        self.titles = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.admins = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.me = None
+        self.logger = logging.getLogger(__name__)
+
+    def title(self, bot, gid):
+        title = self.titles.get(gid)
+        if title == None:
+            title = bot.get_chat(gid).title
+            self.titles.set(gid, title)
+        return title
+
+    def administrators(self, bot, chat_id):
+        admins = self.admins.get(chat_id)
+        if admins == None:
+            admins = bot.get_chat_administrators(chat_id)
+            self.admins.set(chat_id, admins)
+        return admins
+
+    def get_me(self, bot):
+        if self.me == None:
+            self.me = bot.get_me()
+        return self.me
+
+    def observe(self, update):
+        msg = update.message
+        if msg != None and msg.new_chat_title:
+            self.titles.set(msg.chat.id, msg.new_chat_title)
+        for changed in (getattr(update, "chat_member", None), getattr(update, "my_chat_member", None)):
+            if changed == None:
+                continue
+            statuses = (changed.old_chat_member.status,
+                        changed.new_chat_member.status)
+            if "administrator" in statuses or "creator" in statuses:
+                self.admins.pop(changed.chat.id)
+
+    def refresh(self, bot, job=None):
+        for gid in self.titles.keys():
+            try:
+                self.titles.set(gid, bot.get_chat(gid).title)
+            except telegram.TelegramError:
+                self.logger.warning("Refreshing title of %s failed", gid)
+        for chat_id in self.admins.keys():
+            try:
+                self.admins.set(chat_id, bot.get_chat_administrators(chat_id))
+            except telegram.TelegramError:
+                self.logger.warning("Refreshing admins of %s failed", chat_id)
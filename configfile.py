@@ -0,0 +1,10 @@
+import yaml
+
+# libyaml's loader when PyYAML was built against it, the pure Python one
+# otherwise. Both only build plain data.
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load(path):
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=Loader)
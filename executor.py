@@ -0,0 +1,66 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class ChatExecutor(object):
+    # Tasks of one chat run one after another in the order they came in,
+    # different chats run side by side on the worker threads. A chat with a
+    # backlog gets one task per turn so it cannot starve the others.
+    def __init__(self, workers=16):
+        self.cond = threading.Condition()
+        self.chats = {}
+        self.ready = deque()
+        self.counters = {"done": 0, "failed": 0}
+        self.logger = logging.getLogger(__name__)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name="chat_executor_{}".format(i),
+                             daemon=True).start()
+
+    def submit(self, chat_id, func, *args):
+        future = Future()
+        with self.cond:
+            tasks = self.chats.get(chat_id)
+            if tasks == None:
+                tasks = self.chats[chat_id] = deque()
+                self.ready.append(chat_id)
+                self.cond.notify()
+            tasks.append((future, func, args))
+        return future
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while len(self.ready) == 0:
+                    self.cond.wait()
+                chat_id = self.ready.popleft()
+                # The task stays queued while it runs, which keeps the chat
+                # out of the ready queue until it is done
+                future, func, args = self.chats[chat_id][0]
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    self.logger.exception("Task for chat %s failed", chat_id)
+                    future.set_exception(e)
+                    failed = True
+                else:
+                    future.set_result(result)
+            with self.cond:
+                self.counters["failed" if failed else "done"] += 1
+                tasks = self.chats[chat_id]
+                tasks.popleft()
+                if len(tasks) != 0:
+                    self.ready.append(chat_id)
+                    self.cond.notify()
+                else:
+                    del self.chats[chat_id]
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["chats"] = len(self.chats)
+            stats["queued"] = sum(len(tasks) for tasks in self.chats.values())
+            return stats
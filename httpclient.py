@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_in):
+        super(CircuitOpenError, self).__init__(
+            "{} is unavailable, retrying in {:.0f}s".format(name, retry_in))
+        self.name = name
+        self.retry_in = retry_in
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at == None:
+                return "closed"
+            if self.probing:
+                return "half-open"
+            return "open"
+
+    def before(self):
+        with self.lock:
+            if self.opened_at == None:
+                return
+            waited = time.monotonic() - self.opened_at
+            # After the cool-down a single probe is let through
+            if waited >= self.reset_timeout and not self.probing:
+                self.probing = True
+                return
+            raise CircuitOpenError(
+                self.name, max(self.reset_timeout - waited, 0))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at == None:
+                    logging.getLogger(__name__).warning(
+                        "Circuit for %s opened after %d failures", self.name, self.failures)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+class Upstream(object):
+    def __init__(self, name, timeout=(3.05, 10), deadline=20, retries=2, backoff=0.5,
+                 threshold=5, reset_timeout=30):
+        self.name = name
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(name, threshold, reset_timeout)
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class HTTPClient(object):
+    def __init__(self, pool_size=16, call_workers=8, metrics=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.upstreams = {}
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(
+            max_workers=call_workers, thread_name_prefix="upstream")
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, name, **options):
+        self.upstreams[name] = Upstream(name, **options)
+        return self.upstreams[name]
+
+    def _request(self, upstream, attempt, retry_on):
+        if self.metrics == None:
+            return self._retrying(upstream, attempt, retry_on)
+        return self.metrics.timed("aibot_upstream", self._retrying, upstream=upstream.name)(
+            upstream, attempt, retry_on)
+
+    def _retrying(self, upstream, attempt, retry_on):
+        upstream.breaker.before()
+        for i in range(upstream.retries + 1):
+            try:
+                res = attempt()
+            except retry_on as e:
+                upstream.breaker.failure()
+                if i == upstream.retries:
+                    raise
+                self.logger.info("%s attempt %d failed: %s",
+                                 upstream.name, i + 1, e)
+            except Exception:
+                # The upstream answered, the request itself was bad
+                upstream.breaker.success()
+                raise
+            else:
+                upstream.breaker.success()
+                return res
+            time.sleep(upstream.backoff * (2 ** i) * random.uniform(0.5, 1.5))
+            upstream.breaker.before()
+
+    def get(self, name, url, **kwargs):
+        upstream = self.upstreams[name]
+        kwargs.setdefault("timeout", upstream.timeout)
+
+        def attempt():
+            res = self.session.get(url, **kwargs)
+            if res.status_code in RETRY_STATUS:
+                raise UpstreamError("{} returned HTTP {}".format(
+                    upstream.name, res.status_code))
+            res.raise_for_status()
+            return res
+
+        return self._request(upstream, attempt,
+                              (requests.ConnectionError, requests.Timeout, UpstreamError))
+
+    def call(self, name, func, *args, **kwargs):
+        # For third-party clients that do their own HTTP without timeouts:
+        # run them on the bounded pool and stop waiting at the deadline.
+        upstream = self.upstreams[name]
+
+        def attempt():
+            future = self.executor.submit(func, *args, **kwargs)
+            try:
+                return future.result(timeout=upstream.deadline)
+            except FutureTimeout:
+                raise UpstreamError("{} did not answer within {}s".format(
+                    upstream.name, upstream.deadline))
+
+        return self._request(upstream, attempt,
+                              (requests.ConnectionError, requests.Timeout, UpstreamError))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# A stand-in for api.telegram.org and the Tenor API. It answers every
+# method with a plausible result after a configurable delay, can refuse a
+# share of the calls with 429, and counts what it was asked.
+#
+#     python3 loadtest/fake_api.py --port 19980 --latency 0.05 --rate-limit 0.01
+#
+# Point the bot at it with bot_api_url: http://127.0.0.1:19980/bot and
+# tenor_url: http://127.0.0.1:19980/tenor in config.yaml.
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+BOT_ID = 100000
+BOT_PATH = re.compile(r"^/bot[^/]+/(\w+)$")
+SENDING = ("sendMessage", "sendSticker", "sendDocument", "forwardMessage", "editMessageText")
+
+
+class FakeAPI(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Telegram keeps connections open, so do we
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, listen, port, latency=0.05, tenor_latency=0.2, rate_limit=0.0,
+                 tenor_rate_limit=0.0, on_call=None):
+        self.latency = latency
+        self.tenor_latency = tenor_latency
+        self.rate_limit = rate_limit
+        self.tenor_rate_limit = tenor_rate_limit
+        # on_call(method, params) is told about every Bot API call answered
+        self.on_call = on_call
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.limited = {}
+        self.message_ids = itertools.count(1)
+        self.gif_ids = itertools.count(1)
+        HTTPServer.__init__(self, (listen, port), FakeAPIHandler)
+
+    def count(self, table, name):
+        with self.lock:
+            table[name] = table.get(name, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "rate_limited": dict(self.limited)}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake_api", daemon=True).start()
+
+    def message(self, params, **fields):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private",
+                     "title": "Load {}".format(chat_id)},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "LoadBot", "username": "loadbot"},
+        }
+        message.update(fields)
+        return message
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "LoadBot", "username": "loadbot"}
+        if method in ("sendMessage", "editMessageText"):
+            return self.message(params, text=params.get("text", ""))
+        if method == "sendDocument":
+            return self.message(params, document={
+                "file_id": "doc_{}".format(abs(hash(params.get("document")))),
+                "file_unique_id": "doc"})
+        if method == "sendSticker":
+            return self.message(params, sticker={
+                "file_id": params.get("sticker"), "width": 512, "height": 512})
+        if method == "forwardMessage":
+            return self.message(params, text="forwarded")
+        if method == "getChatMember":
+            return {"user": {"id": int(params.get("user_id", 0)), "is_bot": False,
+                             "first_name": "User {}".format(params.get("user_id"))},
+                    "status": "member"}
+        if method == "getChat":
+            return {"id": int(params.get("chat_id", 0)), "type": "supergroup",
+                    "title": "Load {}".format(params.get("chat_id"))}
+        if method == "getChatAdministrators":
+            return []
+        if method == "getChatMembersCount":
+            return 100
+        return True
+
+    def tenor(self, path, params):
+        if path.endswith("/anonid"):
+            return {"anon_id": "loadtest"}
+        limit = int(params.get("limit", ["20"])[0])
+        return {"results": [{"id": str(i), "media": [{"gif": {
+            "url": "https://fake.tenor.invalid/{}.gif".format(next(self.gif_ids))}}]}
+            for i in range(limit)]}
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _limited(self, name):
+        self.server.count(self.server.limited, name)
+        self._reply(429, {"ok": False, "error_code": 429,
+                          "description": "Too Many Requests: retry after 1",
+                          "parameters": {"retry_after": 1}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self._reply(200, self.server.stats())
+            return
+        if not url.path.startswith("/tenor/"):
+            self._bot(url.path, dict((k, v[0]) for k, v in parse_qs(url.query).items()))
+            return
+        time.sleep(self.server.tenor_latency)
+        self.server.count(self.server.calls, "tenor" + url.path[6:])
+        if random.random() < self.server.tenor_rate_limit:
+            self._limited("tenor")
+            return
+        self._reply(200, self.server.tenor(url.path, parse_qs(url.query)))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        try:
+            params = json.loads(body.decode("utf-8")) if body else {}
+        except ValueError:
+            params = {}
+        self._bot(urlparse(self.path).path, params)
+
+    def _bot(self, path, params):
+        m = BOT_PATH.match(path)
+        if m == None:
+            self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        method = m.group(1)
+        time.sleep(self.server.latency)
+        if method in SENDING and random.random() < self.server.rate_limit:
+            self._limited(method)
+            return
+        self.server.count(self.server.calls, method)
+        if self.server.on_call != None:
+            self.server.on_call(method, params)
+        self._reply(200, {"ok": True, "result": self.server.result(method, params)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19980)
+    parser.add_argument("--latency", type=float, default=0.05, help="Bot API delay in seconds")
+    parser.add_argument("--tenor-latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Share of sending calls answered with 429")
+    parser.add_argument("--tenor-rate-limit", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeAPI(args.listen, args.port, args.latency, args.tenor_latency,
+                     args.rate_limit, args.tenor_rate_limit)
+    print("Fake Bot API and Tenor on {}:{}, counters at /stats".format(args.listen, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# End-to-end load test. Starts the fake Bot API and Tenor server, starts the
+# bot against it in a scratch directory, then POSTs a mix of updates to the
+# webhook at a target rate and reports throughput, latency and the API
+# calls the bot made.
+#
+#     python3 loadtest/run.py --rate 200 --duration 30 --latency 0.05 --rate-limit 0.01
+#
+# Latency is taken from the webhook POST to the bot's first API call about
+# that update, e.g. the reply to it or the edit of the pressed message.
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_api import FakeAPI  # noqa: E402
+from storage import Store, Quote  # noqa: E402
+
+TOKEN = "123456:loadtest"
+OWNER = 1
+STICKER = "loadtest_sticker"
+# Share of each kind of update in the generated traffic
+MIX = {
+    "sticker": 25,
+    "action": 20,
+    "trigger": 25,
+    "duel": 10,
+    "quote_callback": 10,
+    "chatter": 10,
+}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class Generator(object):
+    def __init__(self, webhook_port, chats, users):
+        self.webhook_port = webhook_port
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = [1000 + i for i in range(users)]
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # (chat_id, message_id) -> (kind, sent_at), until the bot answers
+        self.waiting = {}
+        self.latencies = {}
+        self.acks = []
+        self.statuses = {}
+        self.sent = {}
+        self.kinds = list(MIX)
+        self.weights = [MIX[kind] for kind in self.kinds]
+
+    def user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": "User", "last_name": str(uid)}
+
+    def message(self, chat_id, uid, **fields):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Load {}".format(chat_id)},
+            "from": self.user(uid),
+        }
+        message.update(fields)
+        return message
+
+    def command(self, chat_id, uid, text, **fields):
+        return self.message(chat_id, uid, text=text, entities=[
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}], **fields)
+
+    def build(self, kind):
+        # Returns the update and the message id the bot's answer refers to
+        chat_id = random.choice(self.chats)
+        uid = random.choice(self.users)
+        if kind == "sticker":
+            msg = self.message(chat_id, uid, sticker={
+                "file_id": STICKER, "file_unique_id": STICKER, "width": 512, "height": 512})
+        elif kind == "action":
+            msg = self.command(chat_id, uid, random.choice(("/hug", "/pat", "/kiss")))
+        elif kind == "trigger":
+            msg = self.message(chat_id, uid, text="ping {}".format(random.randrange(1000)))
+        elif kind == "duel":
+            target = self.message(chat_id, random.choice(self.users), text="hello")
+            msg = self.command(chat_id, uid, "/duel", reply_to_message=target)
+            return {"update_id": next(self.update_ids), "message": msg}, chat_id, target["message_id"]
+        elif kind == "quote_callback":
+            shown = self.message(chat_id, OWNER, text="Quotes 1-3, total 30")
+            query = {"id": str(next(self.update_ids)), "from": self.user(uid), "message": shown,
+                     "chat_instance": str(chat_id), "data": "lsquotes_page:{}".format(
+                         random.randrange(10))}
+            return {"update_id": next(self.update_ids), "callback_query": query}, chat_id, \
+                shown["message_id"]
+        else:
+            msg = self.message(chat_id, uid, text="just chatting {}".format(random.random()))
+            return {"update_id": next(self.update_ids), "message": msg}, None, None
+        return {"update_id": next(self.update_ids), "message": msg}, chat_id, msg["message_id"]
+
+    def on_call(self, method, params):
+        # Called by the fake API for every Bot API call the bot makes
+        ref = params.get("reply_to_message_id") or (
+            params.get("message_id") if method == "editMessageText" else None)
+        if ref == None:
+            return
+        key = (int(params.get("chat_id", 0)), int(ref))
+        with self.lock:
+            waiting = self.waiting.pop(key, None)
+            if waiting != None:
+                self.latencies.setdefault(waiting[0], []).append(time.monotonic() - waiting[1])
+
+    def post(self, kind):
+        update, chat_id, ref = self.build(kind)
+        body = json.dumps(update).encode("utf-8")
+        start = time.monotonic()
+        if ref != None:
+            with self.lock:
+                self.waiting[(chat_id, ref)] = (kind, start)
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", self.webhook_port, timeout=30)
+            conn.request("POST", "/ai/" + TOKEN, body, {"Content-Type": "application/json"})
+            status = conn.getresponse().status
+            conn.close()
+        except OSError as e:
+            status = type(e).__name__
+        with self.lock:
+            self.acks.append(time.monotonic() - start)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.sent[kind] = self.sent.get(kind, 0) + 1
+
+    def run(self, rate, duration, senders):
+        pool = ThreadPoolExecutor(max_workers=senders)
+        start = time.monotonic()
+        total = int(rate * duration)
+        for i in range(total):
+            # Open loop: updates go out on schedule whether or not the bot keeps up
+            delay = start + i / float(rate) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(self.post, random.choices(self.kinds, self.weights)[0])
+        pool.shutdown(wait=True)
+        return time.monotonic() - start
+
+
+def write_bot_config(workdir, args):
+    config = {
+        "apikey": TOKEN,
+        "tenorkey": "loadtest",
+        "owner": OWNER,
+        "groups": {},
+        "watches": {"count": {}, "member": {}},
+        "bot_api_url": "http://127.0.0.1:{}/bot".format(args.api_port),
+        "tenor_url": "http://127.0.0.1:{}/tenor".format(args.api_port),
+        "webhook": {"listen": "127.0.0.1", "port": args.webhook_port,
+                    "url": "http://127.0.0.1:{}".format(args.webhook_port)},
+        "metrics": {"enabled": False},
+        "logging": {"level": "WARNING", "file": os.path.join(workdir, "bot.log")},
+        "sharding": {"workers": args.workers, "base_port": args.webhook_port + 1},
+    }
+    if args.no_send_limits:
+        config["send_queue"] = {"global_rate": 100000, "private_rate": 100000,
+                                "group_rate": 100000, "group_burst": 100000}
+    # JSON is valid YAML
+    with open(os.path.join(workdir, "config.yaml"), "w") as f:
+        json.dump(config, f)
+    shutil.copy(os.path.join(ROOT, "actions.yaml"), workdir)
+    # Something for the stickers, triggers and quote pages to answer with
+    db = Store(os.path.join(workdir, "data.sqlite3"))
+    with db.transaction():
+        db.sticker_response[STICKER] = (1, 0, "text", "sticker reply")
+        db.text_response["^ping"] = (1, 0, "text", "pong")
+        for i in range(30):
+            db.quotes.add(Quote("-1001000000000_{}".format(i), -1001000000000, i,
+                                "User {}".format(i), "quote number {}".format(i), time.time()))
+    db.close()
+
+
+def start_bot(workdir, args, fake):
+    script = "shard.py" if args.workers > 1 else "aibot.py"
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, script)], cwd=workdir)
+    deadline = time.monotonic() + args.startup_timeout
+    while fake.stats()["calls"].get("setWebhook", 0) < 1:
+        if bot.poll() != None or time.monotonic() > deadline:
+            bot.kill()
+            raise SystemExit("The bot did not come up, see {}".format(
+                os.path.join(workdir, "bot.log")))
+        time.sleep(0.1)
+    # The webhook listens before set_webhook is called, but give the
+    # other workers a moment in sharded mode
+    time.sleep(1 if args.workers > 1 else 0)
+    return bot
+
+
+def report(gen, fake, elapsed, drain):
+    answered = sum(len(v) for v in gen.latencies.values())
+    sent = sum(gen.sent.values())
+
+    def ms(value):
+        return None if value == None else round(value * 1000, 1)
+
+    result = {
+        "sent": sent,
+        "elapsed_s": round(elapsed, 2),
+        "offered_rate": round(sent / elapsed, 1),
+        "webhook_status": dict((str(k), v) for k, v in gen.statuses.items()),
+        "webhook_ack_ms": {"p50": ms(percentile(gen.acks, 0.5)),
+                           "p99": ms(percentile(gen.acks, 0.99))},
+        "answered": answered,
+        "unanswered": len(gen.waiting),
+        "answered_rate": round(answered / (elapsed + drain), 1),
+        "response_ms": {"p50": ms(percentile(sum(gen.latencies.values(), []), 0.5)),
+                        "p99": ms(percentile(sum(gen.latencies.values(), []), 0.99))},
+        "response_ms_by_kind": dict(
+            (kind, {"count": len(values), "p50": ms(percentile(values, 0.5)),
+                    "p99": ms(percentile(values, 0.99))})
+            for kind, values in sorted(gen.latencies.items())),
+        "sent_by_kind": gen.sent,
+    }
+    result.update(fake.stats())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=100, help="Updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--drain", type=float, default=10,
+                        help="Seconds to wait for answers after the last update")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=64, help="Concurrent webhook POSTs")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake Bot API delay")
+    parser.add_argument("--tenor-latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Share of sending calls answered with 429")
+    parser.add_argument("--tenor-rate-limit", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=1, help="More than 1 runs shard.py")
+    parser.add_argument("--no-send-limits", action="store_true",
+                        help="Lift the bot's Bot API rate limits to measure its own throughput")
+    parser.add_argument("--api-port", type=int, default=19980)
+    parser.add_argument("--webhook-port", type=int, default=19990)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("-o", "--output", help="Also write the report to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    args = parser.parse_args()
+
+    gen = Generator(args.webhook_port, args.chats, args.users)
+    fake = FakeAPI("127.0.0.1", args.api_port, args.latency, args.tenor_latency,
+                   args.rate_limit, args.tenor_rate_limit, on_call=gen.on_call)
+    fake.start()
+    workdir = tempfile.mkdtemp(prefix="aibot_load")
+    write_bot_config(workdir, args)
+    bot = start_bot(workdir, args, fake)
+    try:
+        elapsed = gen.run(args.rate, args.duration, args.senders)
+        drain_start = time.monotonic()
+        while len(gen.waiting) != 0 and time.monotonic() < drain_start + args.drain:
+            time.sleep(0.1)
+        result = report(gen, fake, elapsed, time.monotonic() - drain_start)
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(15)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        fake.shutdown()
+        if args.keep:
+            print("Scratch directory kept at {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
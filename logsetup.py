@@ -0,0 +1,113 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+
+_context = threading.local()
+
+
+def set_context(**fields):
+    # Update id, chat id and handler name of the work on this thread,
+    # attached to every record it logs
+    _context.__dict__.update(fields)
+
+
+def clear_context():
+    _context.__dict__.clear()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super(TextFormatter, self).__init__(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        line = super(TextFormatter, self).format(record)
+        context = getattr(record, "context", {})
+        if len(context) != 0:
+            line += " " + " ".join("{}={}".format(k, v) for k, v in sorted(context.items()))
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a share of the records below WARNING from the configured loggers
+    # and their children, warnings and errors always pass
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or len(self.rates) == 0:
+            return True
+        name = record.name
+        while True:
+            if name in self.rates:
+                return random.random() < self.rates[name]
+            if "." not in name:
+                return True
+            name = name.rsplit(".", 1)[0]
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    # Only the context is captured on the logging thread, formatting and I/O
+    # happen on the listener thread. A full queue drops records instead of
+    # blocking the caller.
+    def __init__(self, records):
+        super(BackgroundHandler, self).__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.context = dict(_context.__dict__)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(config):
+    # config is the optional "logging" section, see sample_config.yaml
+    records = queue.Queue(config.get("queue_size", 10000))
+    if config.get("file"):
+        output = logging.FileHandler(config["file"], encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if config.get("format", "json") == "json"
+                        else TextFormatter())
+    handler = BackgroundHandler(records)
+    handler.addFilter(SamplingFilter(config.get("sample", {})))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(config.get("level", "INFO"))
+    levels = {"telegram": "WARNING", "urllib3": "WARNING"}
+    levels.update(config.get("levels", {}))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    return handler, listener
@@ -0,0 +1,147 @@
+import re
+import threading
+from collections import OrderedDict
+
+# Triggers that depend on their own group numbering or names cannot be
+# spliced into a shared alternation, they get a pattern of their own.
+STANDALONE = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(")
+# Global flags like (?i) are only allowed at the start of a pattern, in an
+# alternation they are scoped to their own trigger instead
+LEADING_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+# re saves and restores the marks of every group on each failing branch,
+# so an alternation costs quadratic time in its size. Short ones keep the
+# single pass without that.
+CHUNK_SIZE = 16
+
+
+class TextMatcher(object):
+    # Chunks are (regexes, pattern, table) tuples that are never changed.
+    # Writers hold the lock and swap in a new list in which only the chunks
+    # they touched are recompiled, match reads whichever list is current.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = OrderedDict()
+        self.chunks = []
+
+    def load(self, items):
+        # Replaces every trigger, in the given order. When that is the old
+        # order with some triggers dropped and others added at the back, as
+        # /settres and /deltres in another worker leave it, only their
+        # chunks are rebuilt.
+        responses = OrderedDict(items)
+        with self.lock:
+            kept = [regex for regex, response in self.responses.items()
+                    if regex in responses and responses[regex] == response]
+            order = list(responses)
+            if order[:len(kept)] != kept:
+                self.chunks = self._build(responses)
+                self.responses = responses
+                return
+            kept = set(kept)
+            chunks = self._without(self.chunks, set(
+                regex for regex in self.responses if regex not in kept), responses)
+            for regex in order[len(kept):]:
+                chunks = self._appended(chunks, regex, responses)
+            self.chunks = chunks
+            self.responses = responses
+
+    def set(self, regex, response):
+        re.compile(regex)
+        with self.lock:
+            chunks = self.chunks
+            # A replaced trigger goes to the back, like a re-added handler did
+            if self.responses.pop(regex, None) != None:
+                chunks = self._without(chunks, set([regex]), self.responses)
+            self.responses[regex] = response
+            self.chunks = self._appended(chunks, regex, self.responses)
+
+    def remove(self, regex):
+        with self.lock:
+            if self.responses.pop(regex, None) == None:
+                return False
+            self.chunks = self._without(self.chunks, set([regex]), self.responses)
+            return True
+
+    def __len__(self):
+        return len(self.responses)
+
+    def _scoped(self, regex):
+        m = LEADING_FLAGS.match(regex)
+        if m == None:
+            return regex
+        return "(?{}:{})".format(m.group(1), regex[m.end():])
+
+    def _combinable(self, regex):
+        if STANDALONE.search(regex):
+            return False
+        try:
+            re.compile("({})".format(self._scoped(regex)))
+        except re.error:
+            return False
+        return True
+
+    def _chunk(self, regexes, responses):
+        # Up to CHUNK_SIZE consecutive combinable triggers share one
+        # alternation, keeping first-match-wins order. Each trigger is one
+        # outer group, which closes last, so lastindex tells which matched.
+        table = {}
+        parts = []
+        index = 1
+        for regex in regexes:
+            scoped = self._scoped(regex)
+            table[index] = responses[regex]
+            parts.append("({})".format(scoped))
+            index += 1 + re.compile(scoped).groups
+        return (tuple(regexes), re.compile("|".join(parts)), table)
+
+    def _build(self, responses):
+        chunks = []
+        run = []
+        for regex in responses:
+            if self._combinable(regex):
+                run.append(regex)
+                if len(run) == CHUNK_SIZE:
+                    chunks.append(self._chunk(run, responses))
+                    run = []
+            else:
+                if len(run) != 0:
+                    chunks.append(self._chunk(run, responses))
+                    run = []
+                chunks.append(((regex,), re.compile(regex), responses[regex]))
+        if len(run) != 0:
+            chunks.append(self._chunk(run, responses))
+        return chunks
+
+    def _without(self, chunks, dropped, responses):
+        # Only chunks that lose a trigger are recompiled
+        if len(dropped) == 0:
+            return chunks
+        result = []
+        for chunk in chunks:
+            regexes = chunk[0]
+            if dropped.isdisjoint(regexes):
+                result.append(chunk)
+                continue
+            rest = [regex for regex in regexes if regex not in dropped]
+            if len(rest) != 0:
+                result.append(self._chunk(rest, responses))
+        return result
+
+    def _appended(self, chunks, regex, responses):
+        if not self._combinable(regex):
+            return chunks + [((regex,), re.compile(regex), responses[regex])]
+        if len(chunks) != 0:
+            regexes, _, table = chunks[-1]
+            if isinstance(table, dict) and len(regexes) < CHUNK_SIZE:
+                return chunks[:-1] + [self._chunk(regexes + (regex,), responses)]
+        return chunks + [self._chunk([regex], responses)]
+
+    def match(self, text):
+        for _, pattern, table in self.chunks:
+            m = pattern.match(text)
+            if m == None:
+                continue
+            if isinstance(table, dict):
+                return table[m.lastindex]
+            return table
+        return None
@@ -0,0 +1,147 @@
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram.ext import CommandHandler
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+class Metrics(object):
+    # Counters and latency histograms in the Prometheus text format. Label
+    # sets are sorted tuples of (name, value) pairs.
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist == None:
+                hist = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            hist[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[1] += seconds
+
+    def collect(self, prefix, stats):
+        # stats() dicts of the existing components, exported as gauges
+        self.collectors.append((prefix, stats))
+
+    def timed(self, name, func, **labels):
+        @wraps(func)
+        def timed_func(*argl, **argd):
+            start = time.monotonic()
+            try:
+                return func(*argl, **argd)
+            except Exception as e:
+                self.inc(name + "_errors_total", exception=type(e).__name__, **labels)
+                raise
+            finally:
+                self.observe(name + "_seconds", time.monotonic() - start, **labels)
+
+        return timed_func
+
+    def instrument_handler(self, handler):
+        if not getattr(handler.callback, "instrumented", False):
+            if isinstance(handler, CommandHandler):
+                label = "/" + handler.command[0]
+            else:
+                label = handler.callback.__name__
+            handler.callback = self.timed("aibot_handler", handler.callback, handler=label)
+            handler.callback.instrumented = True
+        return handler
+
+    def instrument(self, dispatcher):
+        # Wraps the callbacks of registered handlers, and of those added later
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                self.instrument_handler(handler)
+        add_handler = dispatcher.add_handler
+        dispatcher.add_handler = lambda handler, group=0: add_handler(
+            self.instrument_handler(handler), group)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.help:
+                lines.append("# HELP {} {}".format(name, self.help[name]))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+        for (name, labels), (counts, total) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels + (("le", bound),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+        for prefix, stats in self.collectors:
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)):
+                    header("{}_{}".format(prefix, key), "gauge")
+                    lines.append("{}_{} {}".format(prefix, key, value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, listen, port):
+        self.metrics = metrics
+        HTTPServer.__init__(self, (listen, port), MetricsHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="metrics", daemon=True).start()
+        logging.getLogger(__name__).info(
+            "Serving metrics on %s:%d", *self.server_address[:2])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst != None else max(rate, 1))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def wait_time(self, n=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n:
+                return 0
+            return (n - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        # Used after a 429: drain the bucket so nothing goes out for a while
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
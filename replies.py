@@ -0,0 +1,77 @@
+import json
+import random
+
+import telegram
+
+
+class Replies(object):
+    # The replies most updates go through: trigger and sticker responses,
+    # user id logging and /quote. They only need a bot and an update, so
+    # bench/run.py drives them with stubs.
+    def __init__(self, store, matcher, check_config, send_gif, timers):
+        self.store = store
+        self.matcher = matcher
+        # check_config(gid, key) reads the current group settings
+        self.check_config = check_config
+        # send_gif(bot, cid, keyword, anime, reply_msg)
+        self.send_gif = send_gif
+        # Cooldowns are timers without a handler, so every worker sees them
+        self.timers = timers
+
+    def respond(self, bot, update, response):
+        chance = response[0]
+        cd = response[1]
+        rtype = response[2].lower()
+        content = response[3]
+        # The same response shares its cooldown across chats
+        sig = json.dumps([rtype, content])
+        if cd > 0:
+            if not self.timers.claim("response_cd", sig, cd):
+                return
+        elif self.timers.remaining("response_cd", sig) != None:
+            return
+        if 0 < chance and chance < 1:
+            if random.uniform(0, 1) > chance:
+                return
+        if rtype == "text":
+            update.message.reply_text(content, parse_mode="Markdown")
+        elif rtype == "sticker":
+            update.message.reply_sticker(content)
+        elif rtype == "gif":
+            self.send_gif(bot, update.message.chat.id, content, False, update.message)
+
+    def log_user_id(self, update):
+        gid = update.message.chat.id
+        if self.check_config(gid, "log_uid"):
+            uid = update.message.from_user.id
+            uname = update.message.from_user.username
+            if uname != None:
+                self.store.user_ids[uname] = uid
+
+    def sticker_response(self, bot, update):
+        self.log_user_id(update)
+        response = self.store.sticker_response.get(update.message.sticker.file_id)
+        if response == None:
+            return
+        self.respond(bot, update, response)
+
+    def text_response(self, bot, update):
+        self.log_user_id(update)
+        response = self.matcher.match(update.message.text)
+        if response == None:
+            return
+        self.respond(bot, update, response)
+
+    def quote(self, bot, update):
+        while True:
+            stored = self.store.quotes.random()
+            if stored == None:
+                update.message.reply_text("No quotes present")
+                return
+            gid_to = update.message.chat.id
+            try:
+                bot.forward_message(gid_to, stored.chat_id, stored.message_id)
+                break
+            except telegram.error.BadRequest:
+                # The original message is gone, drop the quote in place
+                self.store.quotes.remove(stored.key)
@@ -0,0 +1,22 @@
+import re
+
+# Han, kana and hangul are written without spaces, so those runs are
+# indexed as overlapping character bigrams instead of words.
+CJK = "぀-ヿ㐀-䶿一-鿿豈-﫿가-힯"
+TOKEN = re.compile("([{0}]+)|([^\\W{0}]+)".format(CJK))
+
+
+def terms(text, query=False):
+    # Indexed text also gets single characters so one-character queries
+    # still hit, queries only use them for one-character runs.
+    found = set()
+    if not text:
+        return found
+    for cjk, word in TOKEN.findall(text.lower()):
+        if word:
+            found.add(word)
+            continue
+        if len(cjk) == 1 or not query:
+            found.update(cjk)
+        found.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return found
@@ -0,0 +1,196 @@
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import telegram
+
+from cache import TTLCache
+from ratelimit import TokenBucket
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class Outgoing(object):
+    def __init__(self, seq, chat_id, priority, func, args, kwargs, merge_key, per_chat=True):
+        self.seq = seq
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        # Only messages count against the chat's limit
+        self.per_chat = per_chat
+        self.futures = [Future()]
+        self.queued_at = time.monotonic()
+
+
+class SendQueue(object):
+    # Bot API limits: about 30 messages per second overall, one per second
+    # in a private chat and 20 per minute in a group.
+    def __init__(self, global_rate=30, private_rate=1, group_rate=20 / 60.0,
+                 group_burst=3, workers=4, metrics=None):
+        self.global_bucket = TokenBucket(global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.chat_buckets = TTLCache(maxsize=10000, ttl=3600)
+        self.cond = threading.Condition()
+        self.pending = []
+        self.merging = {}
+        self.seq = itertools.count()
+        self.metrics = metrics
+        self.counters = {"sent": 0, "merged": 0, "retried": 0}
+        self.logger = logging.getLogger(__name__)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name="send_queue_{}".format(i),
+                             daemon=True).start()
+
+    def _bucket(self, chat_id):
+        if isinstance(chat_id, int) and chat_id < 0:
+            return self.chat_buckets.setdefault(
+                chat_id, lambda: TokenBucket(self.group_rate, self.group_burst))
+        return self.chat_buckets.setdefault(
+            chat_id, lambda: TokenBucket(self.private_rate))
+
+    def submit(self, chat_id, priority, func, args, kwargs, merge_key=None, per_chat=True):
+        with self.cond:
+            if merge_key != None and merge_key in self.merging:
+                # A newer edit of a message still waiting in the queue
+                # replaces the older one, both callers get its result.
+                item = self.merging[merge_key]
+                item.args = args
+                item.kwargs = kwargs
+                item.priority = min(item.priority, priority)
+                item.futures.append(Future())
+                self.counters["merged"] += 1
+                self.pending.sort(key=lambda i: (i.priority, i.seq))
+                return item.futures[-1]
+            item = Outgoing(next(self.seq), chat_id, priority,
+                            func, args, kwargs, merge_key, per_chat)
+            if merge_key != None:
+                self.merging[merge_key] = item
+            self._insert(item)
+            self.cond.notify()
+            return item.futures[0]
+
+    def _insert(self, item):
+        key = (item.priority, item.seq)
+        i = len(self.pending)
+        while i > 0 and (self.pending[i - 1].priority, self.pending[i - 1].seq) > key:
+            i -= 1
+        self.pending.insert(i, item)
+
+    def _take(self):
+        # Highest priority first, but never the chat whose bucket is empty,
+        # so one flooded chat does not hold up the others.
+        while True:
+            wait = 1.0
+            blocked = set()
+            global_wait = self.global_bucket.wait_time()
+            if global_wait == 0:
+                for i, item in enumerate(self.pending):
+                    if item.per_chat and item.chat_id in blocked:
+                        continue
+                    chat_wait = self._bucket(item.chat_id).wait_time() if item.per_chat else 0
+                    if chat_wait == 0:
+                        if self.global_bucket.take():
+                            if item.per_chat:
+                                self._bucket(item.chat_id).take()
+                            del self.pending[i]
+                            if item.merge_key != None:
+                                self.merging.pop(item.merge_key, None)
+                            return item
+                        break
+                    blocked.add(item.chat_id)
+                    wait = min(wait, chat_wait)
+            else:
+                wait = global_wait
+            self.cond.wait(max(wait, 0.01) if len(self.pending) != 0 else None)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                item = self._take()
+            func = item.func
+            if self.metrics != None:
+                self.metrics.observe("aibot_send_queue_wait_seconds",
+                                     time.monotonic() - item.queued_at)
+                func = self.metrics.timed("aibot_telegram", func, method=func.__name__)
+            try:
+                result = func(*item.args, **item.kwargs)
+            except telegram.error.RetryAfter as e:
+                self.logger.warning("Flood limit hit in %s, retrying in %.0fs",
+                                    item.chat_id, e.retry_after)
+                with self.cond:
+                    self._bucket(item.chat_id).pause(e.retry_after)
+                    self.counters["retried"] += 1
+                    self._insert(item)
+                    self.cond.notify()
+                continue
+            except Exception as e:
+                for future in item.futures:
+                    future.set_exception(e)
+                continue
+            with self.cond:
+                self.counters["sent"] += 1
+            for future in item.futures:
+                future.set_result(result)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["queued"] = len(self.pending)
+            return stats
+
+
+class QueuedBot(telegram.Bot):
+    def __init__(self, *args, **kwargs):
+        self.send_queue = kwargs.pop("send_queue")
+        super(QueuedBot, self).__init__(*args, **kwargs)
+
+    def _queued(self, func, default_priority, args, kwargs, merge_key=None, per_chat=True):
+        # Low priority sends return the Future instead of their result, so
+        # a handler does not hold its thread while a busy chat's limit
+        # holds them back
+        priority = kwargs.pop("priority", default_priority)
+        chat_id = kwargs.get("chat_id", args[0] if len(args) != 0 else None)
+        future = self.send_queue.submit(
+            chat_id, priority, func, args, kwargs, merge_key, per_chat)
+        if priority == PRIORITY_LOW:
+            return future
+        return future.result()
+
+    def send_message(self, *args, **kwargs):
+        return self._queued(super(QueuedBot, self).send_message, PRIORITY_NORMAL, args, kwargs)
+
+    def send_sticker(self, *args, **kwargs):
+        return self._queued(super(QueuedBot, self).send_sticker, PRIORITY_NORMAL, args, kwargs)
+
+    def forward_message(self, *args, **kwargs):
+        return self._queued(super(QueuedBot, self).forward_message, PRIORITY_NORMAL, args, kwargs)
+
+    def send_document(self, *args, **kwargs):
+        return self._queued(super(QueuedBot, self).send_document, PRIORITY_LOW, args, kwargs)
+
+    def send_chat_action(self, *args, **kwargs):
+        return self._queued(super(QueuedBot, self).send_chat_action, PRIORITY_LOW, args, kwargs,
+                            per_chat=False)
+
+    def edit_message_text(self, *args, **kwargs):
+        merge_key = None
+        if "chat_id" in kwargs and "message_id" in kwargs:
+            merge_key = ("edit", kwargs["chat_id"], kwargs["message_id"])
+        return self._queued(super(QueuedBot, self).edit_message_text, PRIORITY_NORMAL, args,
+                            kwargs, merge_key)
+
+    sendMessage = send_message
+    sendSticker = send_sticker
+    forwardMessage = forward_message
+    sendDocument = send_document
+    sendChatAction = send_chat_action
+    editMessageText = edit_message_text
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import deque
+
+import configfile
+import logsetup
+from aio import WebhookListener
+
+# Moderation buttons are pressed in the moderator's private chat, but the
+# pending quote or post lives on the worker of the group it came from.
+PENDING_CALLBACK = re.compile(r"(?:approve|decline)_(?:quote|post):(-?\d+)_")
+MESSAGE_KINDS = ("message", "edited_message",
+                 "channel_post", "edited_channel_post")
+
+
+def shard_of(chat_id, shards):
+    # Matches the abs(chat_id) % n filter TimerStore uses in SQL
+    return abs(chat_id) % shards
+
+
+def current():
+    return int(os.environ.get("AIBOT_SHARD", 0)), int(os.environ.get("AIBOT_SHARDS", 1))
+
+
+def update_chat(data):
+    for kind in MESSAGE_KINDS:
+        if kind in data:
+            return data[kind]["chat"]["id"]
+    query = data.get("callback_query")
+    if query != None:
+        m = PENDING_CALLBACK.match(query.get("data") or "")
+        if m != None:
+            return int(m.group(1))
+        if "message" in query:
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+    for value in data.values():
+        if isinstance(value, dict):
+            if "chat" in value:
+                return value["chat"]["id"]
+            if "from" in value:
+                return value["from"]["id"]
+    return 0
+
+
+def effective_chat_id(update):
+    # update_chat for a parsed Update
+    query = update.callback_query
+    if query != None:
+        m = PENDING_CALLBACK.match(query.data or "")
+        if m != None:
+            return int(m.group(1))
+    if update.effective_chat != None:
+        return update.effective_chat.id
+    for kind in ("chat_member", "my_chat_member"):
+        changed = getattr(update, kind, None)
+        if changed != None:
+            return changed.chat.id
+    if update.effective_user != None:
+        return update.effective_user.id
+    return 0
+
+
+class ShardRouter(WebhookListener):
+    # Takes the webhook posts and hands each update to the worker that owns
+    # its chat. Every worker has one queue drained in order, so updates of a
+    # chat reach its worker in the order Telegram sent them.
+    def __init__(self, listen, port, url_path, workers, base_port, max_pending=10000,
+                 retry_delay=0.5, batch_size=100, timeout=10):
+        super(ShardRouter, self).__init__(listen, port, url_path)
+        self.workers = workers
+        self.base_port = base_port
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queues = None
+        self.processes = [None] * workers
+        self.connections = [None] * workers
+        self.forwarded = [0] * workers
+
+    def _accept(self, method, path, body):
+        if method != "POST" or path != self.url_path:
+            return 403
+        try:
+            chat_id = update_chat(json.loads(body.decode("utf-8")))
+        except (ValueError, KeyError, TypeError):
+            return 400
+        queue = self.queues[shard_of(chat_id, self.workers)]
+        if queue.qsize() >= self.max_pending:
+            return 503
+        queue.put_nowait(body)
+        return 200
+
+    def _disconnect(self, index):
+        if self.connections[index] != None:
+            self.connections[index][1].close()
+            self.connections[index] = None
+
+    async def _send(self, index, batch):
+        # Pipelines the batch over the worker's kept-alive connection. The
+        # worker answers in order, each answered update leaves the batch.
+        if self.connections[index] == None:
+            self.connections[index] = await asyncio.open_connection(
+                "127.0.0.1", self.base_port + index)
+        reader, writer = self.connections[index]
+        writer.write(b"".join(
+            "POST {} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            "Content-Length: {}\r\n\r\n".format(self.url_path, len(body)).encode("latin-1") + body
+            for body in batch))
+        await writer.drain()
+        # An overloaded worker answers 503 and closes the connection, so
+        # the refused update and the rest stay in the batch, in order. Only
+        # malformed ones (4xx) are dropped, Telegram was already told they
+        # were delivered.
+        answered = 0
+        try:
+            while answered < len(batch):
+                status = await reader.readline()
+                if not status:
+                    raise ConnectionError("worker {} closed the connection".format(index))
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                code = int(status.split()[1])
+                if code >= 500:
+                    raise ConnectionError("worker {} answered {}".format(index, code))
+                self.forwarded[index] += 1
+                if code != 200:
+                    self.logger.warning("Worker %d answered %d, dropping update", index, code)
+                answered += 1
+        finally:
+            for _ in range(answered):
+                batch.popleft()
+
+    async def _forward(self, index):
+        queue = self.queues[index]
+        batch = deque()
+        while True:
+            if len(batch) == 0:
+                batch.append(await queue.get())
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            # A worker that is down or restarting keeps its updates queued,
+            # resending the unanswered rest of the batch keeps them in order
+            try:
+                await asyncio.wait_for(self._send(index, batch), self.timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError) as e:
+                self._disconnect(index)
+                self.logger.warning("Worker %d unavailable: %r", index, e)
+                await asyncio.sleep(self.retry_delay)
+
+    def _spawn(self, index):
+        env = dict(os.environ, AIBOT_SHARD=str(index), AIBOT_SHARDS=str(self.workers),
+                   AIBOT_PORT=str(self.base_port + index))
+        self.processes[index] = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "aibot.py")],
+            env=env)
+        self.logger.info("Started worker %d as pid %d", index, self.processes[index].pid)
+
+    async def _supervise(self):
+        while True:
+            for index, process in enumerate(self.processes):
+                if process.poll() != None:
+                    self.logger.warning("Worker %d exited with %d, restarting",
+                                        index, process.returncode)
+                    self._spawn(index)
+            await asyncio.sleep(1)
+
+    async def serve(self):
+        # The queues exist before the socket takes the first post
+        self.queues = [asyncio.Queue() for _ in range(self.workers)]
+        await super(ShardRouter, self).serve()
+
+    async def _started(self):
+        for index in range(self.workers):
+            self._spawn(index)
+            asyncio.ensure_future(self._forward(index))
+        asyncio.ensure_future(self._supervise())
+
+    def _stopped(self):
+        for index in range(self.workers):
+            self._disconnect(index)
+        for process in self.processes:
+            process.terminate()
+        deadline = time.monotonic() + 10
+        for process in self.processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def stats(self):
+        return {"queued": [q.qsize() for q in self.queues], "forwarded": list(self.forwarded)}
+
+
+def main():
+    config = configfile.load("config.yaml")
+    logsetup.setup(config.get("logging", {}))
+    sharding = config.get("sharding", {})
+    webhook = config.get("webhook", {})
+    ShardRouter(webhook.get("listen", '127.0.0.1'), webhook.get("port", 9990),
+                "/ai/" + config["apikey"],
+                sharding.get("workers", os.cpu_count()),
+                sharding.get("base_port", 9991),
+                sharding.get("max_pending", 10000)).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache, SingleFlight
+
+StockQuote = namedtuple("StockQuote", "ticker name price change cp")
+
+
+class StockQuotes(object):
+    # Recent quotes are served from a short-lived cache, and concurrent
+    # lookups of one ticker share a single upstream request.
+    def __init__(self, http, ttl=15, max_tickers=10, workers=4):
+        self.http = http
+        self.cache = TTLCache(maxsize=1000, ttl=ttl)
+        self.flight = SingleFlight()
+        self.max_tickers = max_tickers
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="stock")
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+
+    def _fetch(self, ticker):
+        self.misses += 1
+        # wallstreet pulls in scipy and yfinance, which takes seconds, so it
+        # is imported on the first quote rather than at startup
+        from wallstreet import Stock
+        stk = self.http.call("yahoo", Stock, ticker, source="yahoo")
+        quote = StockQuote(stk.ticker, stk.name.replace("&amp;", "&"),
+                           stk.price, stk.change, stk.cp)
+        self.cache.set(ticker, quote)
+        return quote
+
+    def get(self, ticker):
+        ticker = ticker.upper()
+        quote = self.cache.get(ticker)
+        if quote != None:
+            self.hits += 1
+            return quote
+        return self.flight.do(ticker, lambda: self._fetch(ticker))
+
+    def get_many(self, tickers):
+        # Returns (ticker, quote or exception) pairs in the order asked for,
+        # the lookups themselves run side by side.
+        tickers = list(dict.fromkeys(t.upper() for t in tickers))[:self.max_tickers]
+        futures = [(t, self.executor.submit(self.get, t)) for t in tickers]
+        results = []
+        for ticker, future in futures:
+            try:
+                results.append((ticker, future.result()))
+            except Exception as e:
+                self.logger.info("Looking up %s failed: %s", ticker, e)
+                results.append((ticker, e))
+        return results
+
+    def stats(self):
+        return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses,
+                "shared": self.flight.shared}
@@ -0,0 +1,444 @@
+import dbm
+import pickle
+import random
+import shelve
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from heapq import heappush, heapreplace
+from math import log
+
+from search import terms
+
+
+class Table(object):
+    def __init__(self, store, name, key, columns, encode=None, decode=None):
+        self.store = store
+        self.name = name
+        self.key = key
+        self.columns = columns
+        self.encode = encode
+        self.decode = decode
+        cols = ", ".join(columns)
+        self._select = "SELECT {} FROM {} WHERE {} = ?".format(
+            cols, name, key)
+        self._upsert = "INSERT OR REPLACE INTO {} ({}, {}) VALUES ({})".format(
+            name, key, cols, ", ".join("?" * (len(columns) + 1)))
+        self._delete = "DELETE FROM {} WHERE {} = ?".format(name, key)
+        self._items = "SELECT {}, {} FROM {} ORDER BY rowid".format(
+            key, cols, name)
+
+    def _to_row(self, value):
+        if self.encode != None:
+            value = self.encode(value)
+        if len(self.columns) == 1:
+            return (value,)
+        return tuple(value)
+
+    def _from_row(self, row):
+        value = row[0] if len(self.columns) == 1 else tuple(row)
+        if self.decode != None:
+            value = self.decode(value)
+        return value
+
+    def __getitem__(self, k):
+        rows = self.store.query(self._select, (k,))
+        if len(rows) == 0:
+            raise KeyError(k)
+        return self._from_row(rows[0])
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def __contains__(self, k):
+        return len(self.store.query(
+            "SELECT 1 FROM {} WHERE {} = ?".format(self.name, self.key), (k,))) != 0
+
+    def __setitem__(self, k, value):
+        self.store.execute(self._upsert, (k,) + self._to_row(value))
+
+    def __delitem__(self, k):
+        if self.store.execute(self._delete, (k,)).rowcount == 0:
+            raise KeyError(k)
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM {}".format(self.name))[0][0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [row[0] for row in self.store.query(
+            "SELECT {} FROM {} ORDER BY rowid".format(self.key, self.name))]
+
+    def items(self):
+        return [(row[0], self._from_row(row[1:]))
+                for row in self.store.query(self._items)]
+
+
+SNIPPET_LENGTH = 512
+
+
+def placeholders(values):
+    return ", ".join("?" * len(values))
+
+
+class Quote(namedtuple("Quote", ["key", "chat_id", "message_id", "author", "text", "added_at"])):
+    @classmethod
+    def from_message(cls, key, msg, added_at=None):
+        text = msg.text[:SNIPPET_LENGTH] if msg.text else None
+        return cls(key, msg.chat.id, msg.message_id, msg.from_user.full_name, text,
+                   time.time() if added_at == None else added_at)
+
+
+class QuoteBook(object):
+    # Every quote owns a dense slot in 0..n-1, so a random pick is one
+    # indexed lookup. Removing a quote moves the last slot into the hole.
+    columns = "key, chat_id, message_id, author, text, added_at"
+    # Searches count at most this many hits
+    hit_cap = 1000
+    # Postings read per query term in a search's first round, doubling
+    # each round up to search_batch
+    first_batch = 16
+    search_batch = 256
+
+    def __init__(self, store):
+        self.store = store
+        old = [row[1] for row in store.query("PRAGMA table_info(quotes)")]
+        if "value" in old:
+            store.execute("ALTER TABLE quotes RENAME TO quotes_pickled")
+        store.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS quotes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                slot INTEGER UNIQUE NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                author TEXT,
+                text TEXT,
+                added_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS quote_terms (
+                term TEXT NOT NULL,
+                quote_id INTEGER NOT NULL,
+                PRIMARY KEY (term, quote_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS quote_terms_quote ON quote_terms (quote_id);
+            CREATE TABLE IF NOT EXISTS quote_df (
+                term TEXT PRIMARY KEY,
+                count INTEGER NOT NULL) WITHOUT ROWID;
+        """)
+        if "value" in old:
+            self._migrate_pickled()
+        if "quote_index_built" not in store.meta:
+            self._build_index()
+        elif "quote_df_built" not in store.meta:
+            self._build_df()
+
+    def _index(self, quote_id, quote):
+        found = terms(quote.text) | terms(quote.author)
+        self.store.conn.executemany(
+            "INSERT OR IGNORE INTO quote_terms (term, quote_id) VALUES (?, ?)",
+            [(term, quote_id) for term in found])
+        self.store.conn.executemany(
+            "INSERT OR IGNORE INTO quote_df (term, count) VALUES (?, 0)", [(term,) for term in found])
+        self.store.conn.executemany(
+            "UPDATE quote_df SET count = count + 1 WHERE term = ?", [(term,) for term in found])
+
+    def _build_index(self):
+        # Another process may have built it while this one waited for the lock
+        with self.store.transaction(immediate=True):
+            if "quote_index_built" in self.store.meta:
+                return
+            self.store.execute("DELETE FROM quote_terms")
+            self.store.execute("DELETE FROM quote_df")
+            for row in self.store.query("SELECT id, {} FROM quotes".format(self.columns)):
+                self._index(row[0], Quote(*row[1:]))
+            self.store.meta["quote_index_built"] = "1"
+            self.store.meta["quote_df_built"] = "1"
+
+    def _build_df(self):
+        # Document frequencies for an index built before they were kept
+        with self.store.transaction(immediate=True):
+            if "quote_df_built" in self.store.meta:
+                return
+            self.store.execute("DELETE FROM quote_df")
+            self.store.execute(
+                "INSERT INTO quote_df (term, count) SELECT term, COUNT(*) FROM quote_terms GROUP BY term")
+            self.store.meta["quote_df_built"] = "1"
+
+    def _migrate_pickled(self):
+        with self.store.transaction():
+            for key, value in self.store.query(
+                    "SELECT key, value FROM quotes_pickled ORDER BY rowid"):
+                self.add(Quote.from_message(key, pickle.loads(value)))
+            self.store.execute("DROP TABLE quotes_pickled")
+
+    def __len__(self):
+        return self.store.query("SELECT IFNULL(MAX(slot) + 1, 0) FROM quotes")[0][0]
+
+    def __contains__(self, key):
+        return len(self.store.query("SELECT 1 FROM quotes WHERE key = ?", (key,))) != 0
+
+    def get(self, key):
+        rows = self.store.query(
+            "SELECT {} FROM quotes WHERE key = ?".format(self.columns), (key,))
+        return Quote(*rows[0]) if len(rows) != 0 else None
+
+    def add(self, quote):
+        with self.store.transaction():
+            cursor = self.store.execute(
+                "INSERT INTO quotes (slot, {}) VALUES ((SELECT IFNULL(MAX(slot) + 1, 0) FROM quotes), ?, ?, ?, ?, ?, ?)".format(
+                    self.columns), tuple(quote))
+            self._index(cursor.lastrowid, quote)
+
+    def remove(self, key):
+        # The slot read below must still be the quote's when it is moved
+        with self.store.transaction(immediate=True):
+            rows = self.store.query("SELECT id, slot FROM quotes WHERE key = ?", (key,))
+            if len(rows) == 0:
+                return False
+            quote_id, slot = rows[0]
+            self.store.execute("DELETE FROM quotes WHERE key = ?", (key,))
+            self.store.execute(
+                "UPDATE quote_df SET count = count - 1 WHERE term IN (SELECT term FROM quote_terms WHERE quote_id = ?)",
+                (quote_id,))
+            self.store.execute(
+                "DELETE FROM quote_df WHERE count <= 0 AND term IN (SELECT term FROM quote_terms WHERE quote_id = ?)",
+                (quote_id,))
+            self.store.execute("DELETE FROM quote_terms WHERE quote_id = ?", (quote_id,))
+            self.store.execute(
+                "UPDATE quotes SET slot = ? WHERE slot = (SELECT MAX(slot) FROM quotes) AND slot > ?",
+                (slot, slot))
+            return True
+
+    def random(self):
+        with self.store.lock:
+            n = len(self)
+            if n == 0:
+                return None
+            rows = self.store.query(
+                "SELECT {} FROM quotes WHERE slot = ?".format(self.columns), (random.randrange(n),))
+        return Quote(*rows[0])
+
+    def search(self, text, page, n):
+        # Rank by the summed idf of matched query terms, newest first on ties.
+        # Postings are read newest first in rounds, MaxScore style: once a
+        # quote needs one of the rarer terms to make the results, the common
+        # terms' postings are not read any further. Each round scores the
+        # postings in SQLite and only returns quotes that beat the results.
+        query = sorted(terms(text, query=True))
+        if len(query) == 0:
+            return 0, []
+        want = (page + 1) * n
+        with self.store.lock:
+            total_quotes = len(self)
+            weight = dict((term, log(1 + total_quotes / float(count))) for term, count in self.store.query(
+                "SELECT term, count FROM quote_df WHERE term IN ({})".format(placeholders(query)), query))
+            if len(weight) == 0:
+                return 0, []
+            # Most common first. Scores are summed in this order everywhere,
+            # so the same set of terms always adds up to the same float.
+            ordered = sorted(weight, key=lambda term: (weight[term], term))
+            hits = self.store.query(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT quote_id FROM quote_terms WHERE term IN ({}) LIMIT ?)".format(
+                    placeholders(ordered)), ordered + [self.hit_cap])[0][0]
+            scans = {}
+            for term in ordered:
+                # The term the scan reads is known to be there, the others
+                # are looked up by primary key
+                others = [other for other in ordered if other != term]
+                score = " + ".join(
+                    repr(weight[other]) if other == term else
+                    "(CASE WHEN t{}.quote_id IS NULL THEN 0 ELSE {!r} END)".format(
+                        others.index(other), weight[other]) for other in ordered)
+                joins = " ".join(
+                    "LEFT JOIN quote_terms t{0} ON t{0}.term = ? AND t{0}.quote_id = p.quote_id".format(i)
+                    for i in range(len(others)))
+                scans[term] = ("""
+                    SELECT quote_id, score FROM (
+                        SELECT p.quote_id, {} AS score FROM quote_terms p {}
+                        WHERE p.term = ? AND p.quote_id < ? ORDER BY p.quote_id DESC)
+                    WHERE score > ? LIMIT ?""".format(score, joins), others)
+            below = self.store.query("SELECT IFNULL(MAX(id), 0) + 1 FROM quotes")[0][0]
+            # Min-heap of the best (score, quote_id) so far
+            top = []
+            batch = self.first_batch
+            while True:
+                # Quotes read from here on are older than every result, so
+                # they have to score above the worst one. One that has only
+                # a prefix of common terms adding up to no more cannot.
+                floor = top[0][0] if len(top) == want else 0
+                bound = 0
+                for i, term in enumerate(ordered):
+                    bound += weight[term]
+                    if bound > floor:
+                        break
+                else:
+                    break
+                found = {}
+                edge = 0
+                for term in ordered[i:]:
+                    scan, others = scans[term]
+                    rows = self.store.query(scan, others + [term, below, floor, batch])
+                    found.update(rows)
+                    if len(rows) == batch:
+                        edge = max(edge, rows[-1][0])
+                # Every term was read down to edge, the rest waits for the next round
+                for quote_id, quote_score in found.items():
+                    if quote_id < edge:
+                        continue
+                    entry = (quote_score, quote_id)
+                    if len(top) < want:
+                        heappush(top, entry)
+                    elif entry > top[0]:
+                        heapreplace(top, entry)
+                if edge == 0:
+                    break
+                below = edge
+                batch = min(batch * 2, self.search_batch)
+            ranked = [quote_id for _, quote_id in sorted(top, reverse=True)[page * n:]]
+            if len(ranked) == 0:
+                return hits, []
+            quotes = dict((row[0], Quote(*row[1:])) for row in self.store.query(
+                "SELECT id, {} FROM quotes WHERE id IN ({})".format(self.columns, placeholders(ranked)), ranked))
+        return hits, [(quote_id, quotes[quote_id]) for quote_id in ranked]
+
+    def page_after(self, cursor, n):
+        rows = self.store.query(
+            "SELECT id, {} FROM quotes WHERE id > ? ORDER BY id LIMIT ?".format(self.columns),
+            (cursor, n))
+        return [(row[0], Quote(*row[1:])) for row in rows]
+
+    def page_before(self, cursor, n):
+        rows = self.store.query(
+            "SELECT id, {} FROM quotes WHERE id < ? ORDER BY id DESC LIMIT ?".format(self.columns),
+            (cursor, n))
+        return [(row[0], Quote(*row[1:])) for row in reversed(rows)]
+
+    def page_at(self, page, n):
+        rows = self.store.query(
+            "SELECT id, {} FROM quotes ORDER BY id LIMIT ? OFFSET ?".format(self.columns),
+            (n, page * n))
+        return [(row[0], Quote(*row[1:])) for row in rows]
+
+
+class Store(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+            CREATE TABLE IF NOT EXISTS user_ids (
+                uname TEXT PRIMARY KEY,
+                uid INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS sticker_response (
+                sid TEXT PRIMARY KEY,
+                chance REAL NOT NULL,
+                cd INTEGER NOT NULL,
+                rtype TEXT NOT NULL,
+                content TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS text_response (
+                regex TEXT PRIMARY KEY,
+                chance REAL NOT NULL,
+                cd INTEGER NOT NULL,
+                rtype TEXT NOT NULL,
+                content TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS gif_file_ids (
+                url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS timers (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                chat_id INTEGER,
+                due REAL NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (kind, key));
+            CREATE INDEX IF NOT EXISTS timers_due ON timers (due);
+        """)
+        if "attempts" not in [row[1] for row in self.query("PRAGMA table_info(timers)")]:
+            try:
+                self.conn.execute(
+                    "ALTER TABLE timers ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                # Another worker process added it first
+                pass
+        self.meta = Table(self, "meta", "key", ["value"])
+        self.user_ids = Table(self, "user_ids", "uname", ["uid"])
+        self.quotes = QuoteBook(self)
+        self.sticker_response = Table(self, "sticker_response", "sid",
+                                      ["chance", "cd", "rtype", "content"])
+        self.text_response = Table(self, "text_response", "regex",
+                                   ["chance", "cd", "rtype", "content"])
+        self.gif_file_ids = Table(self, "gif_file_ids", "url", ["file_id"])
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # Nested blocks join the outermost transaction. An immediate one
+        # takes the write lock up front, for a block that reads and then
+        # writes what it read while other processes share the database.
+        with self.lock:
+            if self.depth != 0:
+                self.depth += 1
+                try:
+                    yield self
+                finally:
+                    self.depth -= 1
+                return
+            self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self.depth = 1
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+            finally:
+                self.depth = 0
+
+    def migrate_shelve(self, path):
+        # One-shot import of the old whole-dict shelve database
+        if "shelve_migrated" in self.meta or dbm.whichdb(path) in (None, ""):
+            return False
+        old = shelve.open(path, flag="r")
+        try:
+            with self.transaction(immediate=True):
+                # Another shard may have migrated it since the check above
+                if "shelve_migrated" in self.meta:
+                    return False
+                for uname, uid in old.get("user_ids", {}).items():
+                    if uname != None:
+                        self.user_ids[uname] = uid
+                for key, msg in old.get("quotes", {}).items():
+                    self.quotes.add(Quote.from_message(key, msg))
+                for sid, response in old.get("sticker_response", {}).items():
+                    self.sticker_response[sid] = response
+                for regex, response in old.get("text_response", {}).items():
+                    self.text_response[regex] = response
+                self.meta["shelve_migrated"] = path
+        finally:
+            old.close()
+        return True
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,151 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from queue import Queue
+
+from cache import SingleFlight
+
+
+TENOR_URL = "https://api.tenor.com/v1"
+ANON_ID_KEY = "tenor_anon_id"
+
+
+def search_keyword(keyword, anime=True):
+    if anime:
+        return "anime {}".format(keyword)
+    return keyword
+
+
+class Tenor(object):
+    def __init__(self, key, http, url=TENOR_URL, meta=None):
+        self.key = key
+        self.http = http
+        self.url = url
+        # meta is a persistent mapping (db.meta) that keeps the anon_id
+        # across restarts
+        self.meta = meta
+        self.anon_id = None
+        self.flight = SingleFlight()
+
+    def fetch_anon_id(self):
+        res = self.http.get("tenor", "{}/anonid".format(self.url),
+                            params={"key": self.key})
+        self.anon_id = res.json()["anon_id"]
+        if self.meta != None:
+            self.meta[ANON_ID_KEY] = self.anon_id
+        return self.anon_id
+
+    def get_anon_id(self):
+        # Fetched on first use rather than at startup, so a Tenor outage
+        # only fails the GIFs and not the bot
+        if self.anon_id == None and self.meta != None:
+            self.anon_id = self.meta.get(ANON_ID_KEY)
+        if self.anon_id == None:
+            self.flight.do(ANON_ID_KEY, self.fetch_anon_id)
+        return self.anon_id
+
+    def random(self, keyword, limit=20):
+        res = self.http.get(
+            "tenor",
+            "{}/random".format(self.url),
+            params={
+                "key": self.key,
+                "anon_id": self.get_anon_id(),
+                "q": keyword,
+                "safesearch": "moderate",
+                "limit": limit
+            })
+        return res.json()["results"]
+
+
+class GifPool(object):
+    def __init__(self, fetch, low_water=5, recent_size=32):
+        self.fetch = fetch
+        self.low_water = low_water
+        self.recent_size = recent_size
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.pinned = set()
+        self.recent = OrderedDict()
+        self.wanted = Queue()
+        self.queued = set()
+        self.flight = SingleFlight()
+        self.logger = logging.getLogger(__name__)
+        threading.Thread(target=self._refill_loop,
+                         name="gif_prefetch", daemon=True).start()
+
+    def watch(self, keyword):
+        # Pinned keywords (the actions) are kept warm for the bot's lifetime
+        with self.lock:
+            self.pinned.add(keyword)
+            self.pools.setdefault(keyword, deque())
+            self._want(keyword)
+
+    def unwatch(self, keyword):
+        with self.lock:
+            self.pinned.discard(keyword)
+            self.pools.pop(keyword, None)
+
+    def _want(self, keyword):
+        if keyword in self.queued:
+            return
+        self.queued.add(keyword)
+        self.wanted.put(keyword)
+
+    def _touch(self, keyword):
+        if keyword in self.pinned:
+            return
+        self.recent[keyword] = True
+        self.recent.move_to_end(keyword)
+        while len(self.recent) > self.recent_size:
+            old, _ = self.recent.popitem(last=False)
+            self.pools.pop(old, None)
+
+    def _pop(self, keyword):
+        with self.lock:
+            self._touch(keyword)
+            pool = self.pools.setdefault(keyword, deque())
+            if len(pool) == 0:
+                return None
+            result = pool.popleft()
+            if len(pool) < self.low_water:
+                self._want(keyword)
+            return result
+
+    def take(self, keyword):
+        result = self._pop(keyword)
+        if result != None:
+            return result
+        # Pool ran dry, fetch in the caller's thread. Callers arriving
+        # meanwhile, and a prefetch already underway, share that one
+        # request and then each pop a different result.
+        for _ in range(2):
+            if self.flight.do(keyword, lambda: self._refill(keyword)) == 0:
+                return None
+            result = self._pop(keyword)
+            if result != None:
+                return result
+        return None
+
+    def _refill(self, keyword):
+        results = self.fetch(keyword)
+        with self.lock:
+            if keyword in self.pinned or keyword in self.recent:
+                self.pools.setdefault(keyword, deque()).extend(results)
+        return len(results)
+
+    def _refill_loop(self):
+        while True:
+            keyword = self.wanted.get()
+            try:
+                self.flight.do(keyword, lambda: self._refill(keyword))
+            except Exception:
+                self.logger.exception(
+                    "Prefetching GIFs for %s failed", keyword)
+            finally:
+                with self.lock:
+                    self.queued.discard(keyword)
+
+    def stats(self):
+        with self.lock:
+            return dict((keyword, len(pool)) for keyword, pool in self.pools.items())
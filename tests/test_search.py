@@ -0,0 +1,101 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from math import log
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from search import terms  # noqa: E402
+from storage import Store, Quote  # noqa: E402
+
+WORDS = ("apple", "banana", "cherry", "date", "elder", "fig", "grape",
+         "你好", "早上好", "晚安", "哈哈哈")
+
+
+def brute_force(quotes, text, page, n):
+    # Scores every quote: summed idf of the query terms it has, newest
+    # first on ties, summed in the order QuoteBook.search uses
+    found = dict((quote_id, terms(quote.text) | terms(quote.author))
+                 for quote_id, quote in quotes.items())
+    query = terms(text, query=True)
+    df = dict((term, sum(1 for t in found.values() if term in t)) for term in query)
+    weight = dict((term, log(1 + len(quotes) / float(count)))
+                  for term, count in df.items() if count != 0)
+    ordered = sorted(weight, key=lambda term: (weight[term], term))
+    scored = []
+    for quote_id, t in found.items():
+        matched = [term for term in ordered if term in t]
+        if len(matched) != 0:
+            scored.append((sum(weight[term] for term in matched), quote_id))
+    scored.sort(reverse=True)
+    return len(scored), [quote_id for _, quote_id in scored[page * n:(page + 1) * n]]
+
+
+class QuoteSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = Store(os.path.join(self.tmp, "test.sqlite3"))
+        self.quotes = {}
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def add(self, key, text, author="user"):
+        quote = Quote(key, -1, len(self.quotes), author, text, 0)
+        self.db.quotes.add(quote)
+        quote_id = self.db.query("SELECT id FROM quotes WHERE key = ?", (key,))[0][0]
+        self.quotes[quote_id] = quote
+
+    def remove(self, key):
+        self.db.quotes.remove(key)
+        for quote_id, quote in list(self.quotes.items()):
+            if quote.key == key:
+                del self.quotes[quote_id]
+
+    def assertRanked(self, text, page, n=3):
+        hits, entries = self.db.quotes.search(text, page, n)
+        expected_hits, expected = brute_force(self.quotes, text, page, n)
+        self.assertEqual([quote_id for quote_id, _ in entries], expected, text)
+        self.assertEqual(hits, min(expected_hits, self.db.quotes.hit_cap), text)
+
+    def test_co_occurrence_beats_newer_single_terms(self):
+        with self.db.transaction():
+            self.add("both", "apple banana")
+            for i in range(5000):
+                self.add("k{}".format(i), "apple" if i % 2 else "banana")
+        hits, entries = self.db.quotes.search("apple banana", 0, 3)
+        self.assertEqual(entries[0][1].key, "both")
+        for page in range(3):
+            self.assertRanked("apple banana", page)
+
+    def test_random_corpus(self):
+        rng = random.Random(1)
+        with self.db.transaction():
+            for i in range(3000):
+                self.add("k{}".format(i), " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))),
+                         "user {}".format(rng.randrange(20)))
+        for i in rng.sample(range(3000), 500):
+            self.remove("k{}".format(i))
+        queries = list(WORDS) + ["user 3", "zzz", "你好 晚安", "apple user 7"]
+        for _ in range(60):
+            text = " ".join(rng.sample(queries, rng.randint(1, 4)))
+            for page in (0, 1, 9):
+                self.assertRanked(text, page)
+
+    def test_document_frequencies_follow_removals(self):
+        with self.db.transaction():
+            for i in range(50):
+                self.add("k{}".format(i), "apple cherry" if i % 3 else "banana")
+        for i in range(0, 50, 4):
+            self.remove("k{}".format(i))
+        self.assertEqual(
+            set(self.db.query("SELECT term, count FROM quote_df")),
+            set(self.db.query("SELECT term, COUNT(*) FROM quote_terms GROUP BY term")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import logging
+import time
+
+
+class TimerStore(object):
+    # Timers are rows in the store, fired by one repeating tick job, so they
+    # survive restarts and pending ones cost no live job objects.
+    def __init__(self, store, burst=20, shard=0, shards=1, submit=None, lease=600,
+                 retry_delay=30, max_retry_delay=3600, max_attempts=20):
+        self.store = store
+        self.burst = burst
+        # A claimed timer stays in the table lease seconds ahead until its
+        # handler succeeds, so a restart in between fires it again
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.inflight = set()
+        # submit(chat_id, func, *args) runs a due timer, inline by default
+        self.submit = submit
+        # With several worker processes each fires only its own chats' timers
+        self.shard = shard
+        self.shards = shards
+        self.handlers = {}
+        self.logger = logging.getLogger(__name__)
+
+    def register(self, kind, func):
+        self.handlers[kind] = func
+
+    def schedule(self, kind, key, delay, payload=None, chat_id=None):
+        self.store.execute(
+            "INSERT OR REPLACE INTO timers (kind, key, chat_id, due, payload) VALUES (?, ?, ?, ?, ?)",
+            (kind, str(key), chat_id, time.time() + delay, json.dumps(payload or {})))
+
+    def cancel(self, kind, key):
+        return self.store.execute(
+            "DELETE FROM timers WHERE kind = ? AND key = ?", (kind, str(key))).rowcount != 0
+
+    def remaining(self, kind, key):
+        rows = self.store.query(
+            "SELECT due FROM timers WHERE kind = ? AND key = ?", (kind, str(key)))
+        if len(rows) == 0:
+            return None
+        left = rows[0][0] - time.time()
+        return left if left > 0 else None
+
+    def claim(self, kind, key, delay, chat_id=None):
+        # Schedules the timer unless one is still running and tells whether
+        # it did, one process wins when several try at once
+        if self.remaining(kind, key) != None:
+            return False
+        with self.store.transaction(immediate=True):
+            if self.remaining(kind, key) != None:
+                return False
+            self.schedule(kind, key, delay, chat_id=chat_id)
+            return True
+
+    def pending(self):
+        return self.store.query("SELECT COUNT(*) FROM timers")[0][0]
+
+    def tick(self, bot, job=None):
+        now = time.time()
+        # Overdue timers after a restart go out at most burst per tick
+        rows = self.store.query(
+            "SELECT kind, key, chat_id, due, payload, attempts FROM timers "
+            "WHERE due <= ? AND abs(coalesce(chat_id, 0)) % ? = ? ORDER BY due LIMIT ?",
+            (now, self.shards, self.shard, self.burst))
+        for kind, key, chat_id, due, payload, attempts in rows:
+            if (kind, key) in self.inflight:
+                continue
+            handler = self.handlers.get(kind)
+            if handler == None:
+                # Timers without a handler, like duel cooldowns, just expire
+                self.store.execute("DELETE FROM timers WHERE kind = ? AND key = ? AND due = ?",
+                                   (kind, key, due))
+                continue
+            lease = now + self.lease
+            claimed = self.store.execute(
+                "UPDATE timers SET due = ? WHERE kind = ? AND key = ? AND due = ?",
+                (lease, kind, key, due)).rowcount
+            if claimed == 0:
+                continue
+            if now - due > 60:
+                self.logger.info("Firing %s timer %s %.0fs late", kind, key, now - due)
+            self.inflight.add((kind, key))
+            args = (bot, kind, key, lease, attempts, handler, payload)
+            if self.submit != None:
+                self.submit(chat_id or 0, self._fire, *args)
+            else:
+                self._fire(*args)
+
+    def _fire(self, bot, kind, key, lease, attempts, handler, payload):
+        # Rows are matched on the lease, a timer scheduled again meanwhile
+        # is left alone
+        try:
+            handler(bot, json.loads(payload))
+        except Exception:
+            if attempts + 1 >= self.max_attempts:
+                self.logger.exception("%s timer %s failed %d times, giving up",
+                                      kind, key, attempts + 1)
+                self.store.execute("DELETE FROM timers WHERE kind = ? AND key = ? AND due = ?",
+                                   (kind, key, lease))
+                return
+            delay = min(self.retry_delay * 2 ** attempts, self.max_retry_delay)
+            self.logger.exception("%s timer %s failed, retrying in %.0fs", kind, key, delay)
+            self.store.execute(
+                "UPDATE timers SET due = ?, attempts = attempts + 1 "
+                "WHERE kind = ? AND key = ? AND due = ?",
+                (time.time() + delay, kind, key, lease))
+        else:
+            self.store.execute("DELETE FROM timers WHERE kind = ? AND key = ? AND due = ?",
+                               (kind, key, lease))
+        finally:
+            self.inflight.discard((kind, key))
@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from ratelimit import TokenBucket
+
+
+class WatchScheduler(object):
+    def __init__(self, check, min_interval=5, max_interval=300, calls_per_second=5,
+                 backoff=1.5, jitter=0.2):
+        self.check = check
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.budget = TokenBucket(calls_per_second)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.counters = {"checks": 0, "changes": 0, "delayed": 0, "skipped": 0}
+        self.logger = logging.getLogger(__name__)
+
+    def _push(self, key, due):
+        entry = self.entries[key]
+        entry["due"] = due
+        heapq.heappush(self.heap, (due, next(self.seq), key))
+
+    def add(self, key):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = {"interval": self.min_interval, "delayed": False}
+            # Spread the first round over one interval instead of a burst
+            self._push(key, time.monotonic() +
+                       random.uniform(0, self.min_interval))
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    def _next_due(self):
+        while len(self.heap) != 0:
+            due, _, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry == None or entry["due"] != due:
+                heapq.heappop(self.heap)
+                continue
+            return due, key, entry
+        return None
+
+    def tick(self, bot, job=None):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                head = self._next_due()
+                if head == None or head[0] > now:
+                    return
+                due, key, entry = head
+                if not self.budget.take():
+                    for item in self.heap:
+                        other = self.entries.get(item[2])
+                        if item[0] <= now and other != None and not other["delayed"] \
+                                and other["due"] == item[0]:
+                            other["delayed"] = True
+                            self.counters["delayed"] += 1
+                    return
+                heapq.heappop(self.heap)
+                if now - due > entry["interval"]:
+                    self.counters["skipped"] += 1
+                entry["delayed"] = False
+                self.counters["checks"] += 1
+            try:
+                changed = self.check(bot, key)
+            except Exception:
+                self.logger.exception("Watch %s failed", key)
+                changed = False
+            with self.lock:
+                if key not in self.entries:
+                    continue
+                # Members that keep their status are polled less and less often
+                if changed:
+                    self.counters["changes"] += 1
+                    entry["interval"] = self.min_interval
+                else:
+                    entry["interval"] = min(
+                        entry["interval"] * self.backoff, self.max_interval)
+                spread = random.uniform(1 - self.jitter, 1 + self.jitter)
+                self._push(key, time.monotonic() + entry["interval"] * spread)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["watches"] = len(self.entries)
+            return stats